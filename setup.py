@@ -56,6 +56,7 @@ setup(
     install_requires=[
         'setuptools',
         'BTrees',
+        'futures; python_version == "2.7"',
         'nti.base',
         'nti.coremetadata',
         'nti.containers',
@@ -64,8 +65,11 @@ setup(
         'nti.externalization',
         'nti.property',
         'nti.schema',
+        'nti.site',
         'six',
+        'transaction',
         'z3c.schema',
+        'ZODB',
         'zope.app.appsetup',
         'zope.annotation',
         'zope.cachedescriptors',
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Evaluation of segments from :mod:`asyncio` code.
+
+Filter sets are applied in a thread pool so the event loop isn't blocked;
+cancelling (or timing out) an evaluation stops it at the next checkpoint
+between filter set nodes. Requires Python 3.
+
+.. $Id$
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+
+from nti.segments.evaluation import EvaluationContext
+from nti.segments.evaluation import evaluation
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _apply(context, filter_set, initial_set):
+    with evaluation(context):
+        return filter_set.apply(initial_set)
+
+
+class AsyncSegmentEvaluator(object):
+    """
+    Evaluates filter sets in a pool of at most ``max_concurrency`` worker
+    threads, returning awaitables for their results.
+
+    The filter sets and initial sets given must be safe to use from the
+    worker threads.
+    """
+
+    max_concurrency = 4
+
+    def __init__(self, max_concurrency=None):
+        if max_concurrency is not None:
+            self.max_concurrency = max_concurrency
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+
+    def evaluate(self, filter_set, initial_set, timeout=None):
+        """
+        Return an awaitable for the :class:`~nti.segments.interfaces.IIntIdSet`
+        result of applying the filter set to the initial set, for the current
+        event loop.
+
+        If the awaitable is cancelled, or ``timeout`` seconds pass before it
+        completes, the evaluation is cancelled.
+        """
+        context = EvaluationContext(timeout)
+        future = asyncio.get_event_loop().run_in_executor(self.executor, _apply,
+                                                          context, filter_set,
+                                                          initial_set)
+
+        def _cancel_evaluation(done):
+            if done.cancelled():
+                context.cancel()
+        future.add_done_callback(_cancel_evaluation)
+
+        if timeout is not None:
+            return asyncio.wait_for(future, timeout)
+        return future
+
+    def evaluate_segment(self, segment, initial_set, timeout=None):
+        """
+        Like :meth:`evaluate`, for the filter set of the given segment.
+        """
+        return self.evaluate(segment.filter_set, initial_set, timeout)
+
+    def evaluate_segments(self, segments, initial_set, timeout=None):
+        """
+        Return an awaitable for a list of the results of each segment,
+        evaluated concurrently.
+        """
+        return asyncio.gather(*[self.evaluate_segment(segment, initial_set, timeout)
+                                for segment in segments])
+
+    def close(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Bulk export and import of segment definitions as JSON Lines of
+externalized segments.
+
+.. $Id$
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+
+import six
+
+from zope.container.constraints import checkObject
+
+from zope.event import notify
+
+from nti.externalization import to_external_object
+from nti.externalization import update_from_external_object
+
+from nti.externalization.internalization import find_factory_for
+
+from nti.segments.interfaces import SegmentsImportedEvent
+
+from nti.segments.model import allocate_segment_id
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The default number of segments imported between calls to ``on_chunk``
+DEFAULT_CHUNK_SIZE = 500
+
+
+def export_segments(segments, stream):
+    """
+    Write each segment to the text stream as a line of JSON, returning the
+    number written.
+    """
+    count = 0
+    for segment in segments:
+        # json.dumps gives (ASCII) bytes on Python 2
+        stream.write(six.text_type(json.dumps(to_external_object(segment),
+                                              sort_keys=True)))
+        stream.write(u'\n')
+        count += 1
+    return count
+
+
+def _read_segments(stream):
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        external = json.loads(line)
+        factory = find_factory_for(external)
+        if factory is None:
+            raise ValueError("No factory for segment %r" % (line[:80],))
+        segment = factory()
+        update_from_external_object(segment, external, notify=False)
+        yield segment
+
+
+def import_segments(container, stream, chunk_size=DEFAULT_CHUNK_SIZE, on_chunk=None):
+    """
+    Add the segments read from a stream written by :func:`export_segments`
+    to the container, as new segments.
+
+    Rather than an event per segment, an
+    :class:`~nti.segments.interfaces.ISegmentsImportedEvent` is fired for
+    each chunk of ``chunk_size`` segments once they are added, so
+    subscribers needing to act on each segment must handle that.
+
+    :param on_chunk: If given, called with the list of segments added after
+        the event for each chunk, e.g. to commit the transaction.
+    :return: The list of imported segments.
+    """
+    def added(chunk):
+        container.updateLastMod()
+        notify(SegmentsImportedEvent(container, chunk))
+        if on_chunk is not None:
+            on_chunk(chunk)
+
+    result = []
+    chunk = []
+    for segment in _read_segments(stream):
+        name = allocate_segment_id(container)
+        checkObject(container, name, segment)
+        # pylint: disable=protected-access
+        container._intern_segment(name, segment)
+        segment.id = name
+        segment.__parent__ = container
+        segment.__name__ = name
+        container._setitemf(name, segment)
+        result.append(segment)
+        chunk.append(segment)
+        if len(chunk) >= chunk_size:
+            added(chunk)
+            chunk = []
+    if chunk:
+        added(chunk)
+    return result
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A canonical form for filter set trees, so that logically equal trees can
+be recognized, stored and evaluated once.
+
+In canonical form duplicate children of commutative nodes (unions and
+intersections) are removed; the order of the remaining children is kept,
+as it may have been chosen for evaluation cost. Children are compared
+in sorted order, so trees differing only in that order have the same
+canonical key.
+
+Leaves are compared by their schema fields. Leaves with state not
+described by their schema have no canonical key, and neither do the
+trees containing them; such trees are never interned.
+
+.. $Id$
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from persistent import Persistent
+
+from zope import interface
+
+from zope.schema import getFieldsInOrder
+
+from nti.segments.interfaces import IDifferenceUserFilterSet
+from nti.segments.interfaces import IIntersectionUserFilterSet
+from nti.segments.interfaces import INotUserFilterSet
+from nti.segments.interfaces import IUnionUserFilterSet
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _commutative(filter_set):
+    for iface in (IUnionUserFilterSet, IIntersectionUserFilterSet):
+        if iface.providedBy(filter_set):
+            return iface
+    return None
+
+
+def hashable(value):
+    """
+    Return a hashable equivalent of a value, converting any lists, sets and
+    dictionaries it contains to tuples.
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(hashable(x) for x in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(hashable(x) for x in value))
+    if isinstance(value, dict):
+        return tuple(sorted((k, hashable(v)) for k, v in value.items()))
+    return value
+
+
+#: Attributes not part of a leaf's logical state
+_IGNORED_STATE = ('__parent__', '__name__')
+
+
+def _leaf_structure(filter_set):
+    fields = []
+    names = set()
+    for iface in interface.providedBy(filter_set).flattened():
+        for name, unused_field in getFieldsInOrder(iface):
+            names.add(name)
+            fields.append((name, hashable(getattr(filter_set, name, None))))
+    if isinstance(filter_set, Persistent):
+        filter_set._p_activate()
+    state = getattr(filter_set, '__dict__', None)
+    if state is None:
+        return None
+    for name in state:
+        if name not in names and name not in _IGNORED_STATE \
+                and not name.startswith('_v_'):
+            # Two such leaves may differ in ways we can't see
+            return None
+    return tuple(sorted(set(fields)))
+
+
+def _child_keys(filter_sets):
+    keys = [canonical_key(x) for x in filter_sets]
+    return None if None in keys else keys
+
+
+def _structure(filter_set):
+    mime_type = getattr(filter_set, 'mimeType', None) or type(filter_set).__name__
+    if _commutative(filter_set) is not None:
+        children = _child_keys(filter_set.filter_sets)
+        if children is None:
+            return None
+        return (mime_type, tuple(sorted(set(children))))
+    if INotUserFilterSet.providedBy(filter_set):
+        children = _child_keys((filter_set.filter_set,))
+    elif IDifferenceUserFilterSet.providedBy(filter_set):
+        children = _child_keys((filter_set.filter_set,
+                                filter_set.excluded_filter_set))
+    else:
+        leaf = _leaf_structure(filter_set)
+        return None if leaf is None else (mime_type, leaf)
+    return None if children is None else (mime_type,) + tuple(children)
+
+
+def canonical_key(filter_set):
+    """
+    Return a string equal for any two filter set trees with the same
+    canonical form, or ``None`` if the tree has no canonical form.
+    """
+    structure = _structure(filter_set)
+    return None if structure is None else repr(structure)
+
+
+def canonicalize(filter_set):
+    """
+    Return the canonical form of the filter set tree. Combinator nodes are
+    copied; leaves are reused.
+    """
+    if _commutative(filter_set) is not None:
+        children = []
+        seen = set()
+        for child in filter_set.filter_sets:
+            child = canonicalize(child)
+            key = canonical_key(child)
+            if key is None or key not in seen:
+                seen.add(key)
+                children.append(child)
+        return type(filter_set)(filter_sets=tuple(children))
+    if INotUserFilterSet.providedBy(filter_set):
+        return type(filter_set)(filter_set=canonicalize(filter_set.filter_set))
+    if IDifferenceUserFilterSet.providedBy(filter_set):
+        return type(filter_set)(
+            filter_set=canonicalize(filter_set.filter_set),
+            excluded_filter_set=canonicalize(filter_set.excluded_filter_set))
+    return filter_set
+
+
+def _children(filter_set):
+    if _commutative(filter_set) is not None:
+        return tuple(filter_set.filter_sets)
+    if INotUserFilterSet.providedBy(filter_set):
+        return (filter_set.filter_set,)
+    if IDifferenceUserFilterSet.providedBy(filter_set):
+        return (filter_set.filter_set, filter_set.excluded_filter_set)
+    return ()
+
+
+def _intern(filter_set, table, counts):
+    # Children first, so equal subtrees of distinct trees are shared too
+    if _commutative(filter_set) is not None:
+        filter_set.filter_sets = tuple(_intern(x, table, counts)
+                                       for x in filter_set.filter_sets)
+    elif INotUserFilterSet.providedBy(filter_set):
+        filter_set.filter_set = _intern(filter_set.filter_set, table, counts)
+    elif IDifferenceUserFilterSet.providedBy(filter_set):
+        filter_set.filter_set = _intern(filter_set.filter_set, table, counts)
+        filter_set.excluded_filter_set = _intern(filter_set.excluded_filter_set,
+                                                 table, counts)
+    key = canonical_key(filter_set)
+    if key is None:
+        return filter_set
+    existing = table.get(key)
+    if existing is not None and canonical_key(existing) != key:
+        # Changed in place since it was interned; no longer equal
+        del table[key]
+        if counts is not None:
+            counts.pop(key, None)
+        existing = None
+    if existing is None:
+        existing = table[key] = filter_set
+    if counts is not None:
+        counts[key] = counts.get(key, 0) + 1
+    return existing
+
+
+def intern_filter_set(filter_set, table, counts=None):
+    """
+    Return the canonical form of the filter set, with every subtree
+    replaced by the equal one already in the table (a mapping of canonical
+    keys to filter sets), adding those not yet there. The replacement may
+    order its children differently.
+
+    :param counts: If given, a mapping of canonical keys to the number of
+        times the subtree has been interned, for :func:`release_filter_set`.
+    """
+    return _intern(canonicalize(filter_set), table, counts)
+
+
+def release_filter_set(filter_set, table, counts):
+    """
+    Release a filter set returned by :func:`intern_filter_set`, removing
+    the subtrees of the table no longer used by any interned tree.
+
+    Subtrees are released by canonical key, so the filter set need not be
+    the same object as was interned (e.g. a copy of a leaf that is not
+    persistent), but it must not have been changed in place since. Those
+    interned without being counted are left in the table.
+    """
+    for child in _children(filter_set):
+        release_filter_set(child, table, counts)
+    key = canonical_key(filter_set)
+    count = None if key is None else counts.get(key)
+    if count is None:
+        return
+    if count <= 1:
+        table.pop(key, None)
+        del counts[key]
+    else:
+        counts[key] = count - 1
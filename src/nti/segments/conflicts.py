@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Conflict resolution for the persistent state of segments, so that
+concurrent refreshes and edits touching different attributes of the same
+object don't force a transaction retry.
+
+.. $Id$
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numbers
+
+from ZODB.POSException import ConflictError
+
+logger = __import__('logging').getLogger(__name__)
+
+_MISSING = object()
+
+
+def _same(a, b):
+    if a is b:
+        return True
+    try:
+        return bool(a == b)
+    except Exception:  # pylint: disable=broad-except
+        # e.g. persistent references that can't be compared
+        return False
+
+
+def _number(value):
+    return 0 if value is _MISSING or value is None else value
+
+
+def _numeric(*values):
+    return all(value is _MISSING or value is None or isinstance(value, numbers.Number)
+               for value in values)
+
+
+def resolve_state(old, committed, new, counters=(), timestamps=()):
+    """
+    Merge the states of two concurrent changes to an object.
+
+    Attributes changed by only one side take that side's value.
+    ``counters`` are merged by adding both sides' increments and
+    ``timestamps`` by taking the latest, when their values are numbers
+    (rather than, say, references to persistent objects resolving their
+    own conflicts). Any other attribute changed differently by both sides
+    is a real conflict.
+
+    :raises ConflictError: If the changes can't be merged.
+    """
+    if not all(isinstance(state, dict) for state in (old, committed, new)):
+        raise ConflictError("Can only resolve dictionary states")
+    result = {}
+    for key in set(old) | set(committed) | set(new):
+        original = old.get(key, _MISSING)
+        mine = committed.get(key, _MISSING)
+        theirs = new.get(key, _MISSING)
+        if key in counters:
+            value = _number(mine) + _number(theirs) - _number(original)
+        elif key in timestamps and _numeric(original, mine, theirs):
+            value = max(_number(mine), _number(theirs))
+        elif _same(theirs, original):
+            value = mine
+        elif _same(mine, original) or _same(mine, theirs):
+            value = theirs
+        else:
+            raise ConflictError("Conflicting changes to %r" % (key,))
+        if value is not _MISSING:
+            result[key] = value
+    return result
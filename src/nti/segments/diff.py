@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Changes in segment membership between evaluations.
+
+.. $Id$
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from BTrees.OOBTree import OOBTree
+
+from persistent import Persistent
+
+from zope import component
+from zope import interface
+
+from zope.annotation import factory as an_factory
+
+from zope.container.contained import Contained
+
+from nti.segments.interfaces import ISegment
+from nti.segments.interfaces import ISegmentMembershipDiff
+from nti.segments.interfaces import ISegmentMembershipSnapshots
+
+from nti.segments.model import IntIdSet
+from nti.segments.model import SegmentResult
+
+logger = __import__('logging').getLogger(__name__)
+
+SNAPSHOTS_ANNOTATION_KEY = 'nti.segments.diff.SegmentMembershipSnapshots'
+
+
+@interface.implementer(ISegmentMembershipDiff)
+class SegmentMembershipDiff(object):
+
+    def __init__(self, added, removed, result):
+        self.added = added
+        self.removed = removed
+        self.result = result
+
+
+@component.adapter(ISegment)
+@interface.implementer(ISegmentMembershipSnapshots)
+class SegmentMembershipSnapshots(Persistent, Contained):
+
+    def __init__(self):
+        self._snapshots = OOBTree()
+
+    def get(self, consumer, default=None):
+        return self._snapshots.get(consumer, default)
+
+    def replace(self, consumer, intids):
+        self._snapshots[consumer] = SegmentResult(intids)
+        return self._snapshots[consumer]
+
+    def remove(self, consumer):
+        self._snapshots.pop(consumer, None)
+
+
+_SegmentMembershipSnapshotsFactory = an_factory(SegmentMembershipSnapshots,
+                                                SNAPSHOTS_ANNOTATION_KEY)
+
+
+def diff_segment(segment, initial_set, consumer):
+    """
+    Evaluate the segment against the initial set and compare the result
+    with the membership the consumer saw the last time it asked, which is
+    then replaced by the new one. Consumers not seen before have no
+    members to compare with.
+
+    Each consumer, named by a string, has its own snapshot, so consumers
+    don't see each other's changes as already handled; the segment's
+    published ``result`` is neither used nor changed.
+
+    :return: An :class:`~nti.segments.interfaces.ISegmentMembershipDiff`.
+    """
+    if segment.filter_set is None:
+        current = initial_set.difference(initial_set)
+    else:
+        current = segment.filter_set.apply(initial_set)
+
+    snapshots = ISegmentMembershipSnapshots(segment)
+    previous = snapshots.get(consumer)
+    if previous is None:
+        added = current
+        removed = current.difference(current)
+    else:
+        previous = IntIdSet(previous.intids)
+        added = current.difference(previous)
+        removed = previous.difference(current)
+
+    result = snapshots.replace(consumer, current.intids())
+    return SegmentMembershipDiff(added, removed, result)
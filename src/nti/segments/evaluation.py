@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+State shared by the filter sets evaluated within a single evaluation pass.
+
+Filter sets keep the simple ``apply(initial_set)`` signature; anything that
+needs to span a whole pass is kept on the :class:`EvaluationContext` that is
+current for the evaluating thread.
+
+.. $Id$
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+
+from contextlib import contextmanager
+
+logger = __import__('logging').getLogger(__name__)
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class EvaluationCancelled(Exception):
+    """
+    Raised within an evaluation that has been cancelled, from the first
+    checkpoint reached afterwards.
+    """
+
+    def __init__(self, filter_set):
+        Exception.__init__(self, filter_set)
+        #: The filter set being evaluated when the cancellation was noticed
+        self.filter_set = filter_set
+
+
+class EvaluationBudgetExceeded(EvaluationCancelled):
+    """
+    Raised within an evaluation that has run past its deadline or processed
+    more intids than its budget allows.
+    """
+
+    def __init__(self, filter_set, processed, elapsed):
+        EvaluationCancelled.__init__(self, filter_set)
+        #: The number of intids in the intermediate results so far
+        self.processed = processed
+        #: The seconds since the evaluation started
+        self.elapsed = elapsed
+
+    def __str__(self):
+        return "Evaluation budget exceeded in %r after %s intids and %.3fs" % (
+            self.filter_set, self.processed, self.elapsed)
+
+
+def _size(result_set):
+    try:
+        return len(result_set)
+    except TypeError:
+        return len(result_set.intids())
+
+
+class EvaluationContext(object):
+    """
+    :param timeout: Seconds after which the evaluation is stopped.
+    :param max_intids: The number of intids the intermediate results
+        checked so far may total before the evaluation is stopped.
+    :param share_results: Whether a filter set object applied more than
+        once to the same initial set (as when segments share interned
+        subtrees) is only evaluated the first time.
+    :param record_cardinalities: Whether to record the size of the result
+        of each filter set evaluated through :func:`cached_result`.
+    :param intid_range: An inclusive ``(min, max)`` tuple of the intids the
+        initial set is limited to, so leaves can read only that slice of
+        their indexes (see :func:`range_slice`).
+    """
+
+    cancelled = False
+
+    def __init__(self, timeout=None, max_intids=None, share_results=False,
+                 record_cardinalities=False, intid_range=None):
+        #: Index contents read during the pass, keyed by the reader
+        self.catalog_reads = {}
+        #: Results of applying (shared) filter sets to the same initial set
+        self.results = {} if share_results else None
+        #: The size of the last result of each filter set, keyed by its id
+        self.cardinalities = {} if record_cardinalities else None
+        self.started = _clock()
+        self.deadline = None if timeout is None else self.started + timeout
+        self.max_intids = max_intids
+        self.processed = 0
+        self.intid_range = intid_range
+
+    def cancel(self):
+        """
+        Request that the evaluation stop at its next checkpoint. May be
+        called from any thread.
+        """
+        self.cancelled = True
+
+    @property
+    def elapsed(self):
+        return _clock() - self.started
+
+    def check(self, filter_set, result_set=None):
+        if self.cancelled:
+            raise EvaluationCancelled(filter_set)
+        if result_set is not None:
+            # Counted whatever the budget, for reporting
+            self.processed += _size(result_set)
+            if self.max_intids is not None and self.processed > self.max_intids:
+                raise EvaluationBudgetExceeded(filter_set, self.processed, self.elapsed)
+        if self.deadline is not None and _clock() > self.deadline:
+            raise EvaluationBudgetExceeded(filter_set, self.processed, self.elapsed)
+
+
+class _Local(threading.local):
+    context = None
+
+
+_local = _Local()
+
+
+def current_evaluation():
+    """
+    Return the :class:`EvaluationContext` active in this thread, if any.
+    """
+    return _local.context
+
+
+@contextmanager
+def evaluation(context=None):
+    """
+    Make the given (or a new) :class:`EvaluationContext` current for the
+    duration of the block.
+    """
+    context = EvaluationContext() if context is None else context
+    previous = _local.context
+    _local.context = context
+    try:
+        yield context
+    finally:
+        _local.context = previous
+
+
+def checkpoint(filter_set, result_set=None):
+    """
+    Called by combinator filter sets between evaluating their children
+    with their intermediate result, raising :class:`EvaluationCancelled`
+    if the current evaluation has been cancelled, or
+    :class:`EvaluationBudgetExceeded` if it is over budget.
+    """
+    context = _local.context
+    if context is not None:
+        context.check(filter_set, result_set)
+
+
+def cached_result(filter_set, initial_set):
+    """
+    Apply the filter set to the initial set, reusing the result of doing so
+    earlier in the current evaluation if it shares results, and recording
+    its size if it records cardinalities.
+    """
+    context = _local.context
+    if context is None:
+        return filter_set.apply(initial_set)
+    if context.results is None:
+        result = filter_set.apply(initial_set)
+    else:
+        key = (id(filter_set), id(initial_set))
+        try:
+            result = context.results[key][2]
+        except KeyError:
+            result = filter_set.apply(initial_set)
+            # Keep the keyed objects alive so their ids aren't reused
+            context.results[key] = (filter_set, initial_set, result)
+    if context.cardinalities is not None:
+        context.cardinalities[id(filter_set)] = _size(result)
+    return result
+
+
+def evaluate_segments(segments, initial_set):
+    """
+    Evaluate the segments against the same initial set, sharing the results
+    of the filter set objects they have in common.
+
+    :return: A mapping of segment ids to :class:`~nti.segments.interfaces.IIntIdSet`.
+    """
+    result = {}
+    with evaluation(EvaluationContext(share_results=True)):
+        for segment in segments:
+            if segment.filter_set is not None:
+                result[segment.id] = cached_result(segment.filter_set, initial_set)
+    return result
+
+
+def evaluate(filter_set, initial_set, timeout=None, max_intids=None):
+    """
+    Apply the filter set to the initial set, stopping with
+    :class:`EvaluationBudgetExceeded` if that takes longer than ``timeout``
+    seconds or the intermediate results total more than ``max_intids``.
+    """
+    with evaluation(EvaluationContext(timeout, max_intids)):
+        return filter_set.apply(initial_set)
+
+
+def cached_catalog_read(key, factory):
+    """
+    Return the result of ``factory()``, sharing it with any other read of
+    the same key within the current evaluation.
+    """
+    context = _local.context
+    if context is None:
+        return factory()
+    try:
+        result = context.catalog_reads[key]
+    except KeyError:
+        result = context.catalog_reads[key] = factory()
+    return result
+
+
+def range_slice(intids):
+    """
+    Return the part of a :mod:`BTrees` set of intids within the range the
+    current evaluation is limited to, as a sequence; without a range, the
+    set itself.
+    """
+    context = _local.context
+    if context is None or context.intid_range is None:
+        return intids
+    low, high = context.intid_range
+    return intids.keys(low, high)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A compact binary format for passing sets of intids between processes.
+
+A buffer holds a 16 byte header followed by the sorted intids as little
+endian 64-bit integers. Such buffers (bytes, memory mapped files,
+:class:`multiprocessing.shared_memory.SharedMemory` blocks) can be read
+through a :class:`memoryview` without copying. Alternatively the intids
+may be stored compressed: the (non-negative) differences between
+consecutive intids, the first taken from the smallest 64-bit integer,
+as zlib compressed unsigned LEB128 varints. That is much smaller for
+dense sets, and never larger than 10 bytes an intid for sparse ones,
+but must be decompressed to be read.
+
+Header layout: the magic ``NTIS``, a format version byte, a flags byte,
+two reserved bytes and the number of intids as an unsigned 64-bit integer.
+
+.. $Id$
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import mmap
+import struct
+import sys
+import zlib
+
+from array import array
+
+import BTrees
+
+from nti.segments.model import IntIdSet
+from nti.segments.model import _to_intids
+
+logger = __import__('logging').getLogger(__name__)
+
+MAGIC = b'NTIS'
+VERSION = 1
+
+#: Flag set when the intids are stored compressed
+COMPRESSED = 0x01
+
+_HEADER = struct.Struct('<4sBBHQ')
+HEADER_SIZE = _HEADER.size
+
+_TYPECODE = 'q'
+_SWAP = sys.byteorder != 'little'
+
+_frombytes = getattr(array, 'frombytes', None) or array.fromstring  # pylint: disable=no-member
+_tobytes = getattr(array, 'tobytes', None) or array.tostring  # pylint: disable=no-member
+
+
+def _array_bytes(values):
+    if _SWAP:  # pragma: no cover
+        values.byteswap()
+    return _tobytes(values)
+
+
+#: The deltas start from the smallest 64-bit integer, so are never negative
+_ORIGIN = -2 ** 63
+
+
+def _encode_deltas(intids):
+    result = bytearray()
+    previous = _ORIGIN
+    for intid in intids:
+        delta = intid - previous
+        previous = intid
+        while delta >= 0x80:
+            result.append((delta & 0x7F) | 0x80)
+            delta >>= 7
+        result.append(delta)
+    return bytes(result)
+
+
+def _decode_deltas(data):
+    result = array(_TYPECODE)
+    value = _ORIGIN
+    delta = shift = 0
+    for byte in bytearray(data):
+        delta |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            value += delta
+            result.append(value)
+            delta = shift = 0
+    return result
+
+
+def dumps(result_set, compress=False):
+    """
+    Return the bytes encoding an :class:`~nti.segments.interfaces.IIntIdSet`
+    or :mod:`BTrees` set.
+    """
+    intids = _to_intids(result_set)
+    if compress:
+        payload = zlib.compress(_encode_deltas(intids))
+        values = None
+    else:
+        values = array(_TYPECODE, intids)
+        payload = _array_bytes(values)
+    count = len(values) if values is not None else len(intids)
+    header = _HEADER.pack(MAGIC, VERSION, COMPRESSED if compress else 0, 0, count)
+    return header + payload
+
+
+def dump(result_set, fileobj, compress=False):
+    """
+    Write the encoding of the set to a binary file, e.g. one to be memory
+    mapped by the reader with :func:`load_mapped`.
+    """
+    fileobj.write(dumps(result_set, compress))
+
+
+def read_header(buf):
+    """
+    Return the flags and count of the encoded set in the buffer.
+
+    :raises ValueError: If the buffer does not hold an encoded set.
+    """
+    if len(buf) < HEADER_SIZE:
+        raise ValueError("Buffer too small for an intid set header")
+    magic, version, flags, _, count = _HEADER.unpack_from(buf)
+    if magic != MAGIC:
+        raise ValueError("Not an intid set buffer")
+    if version != VERSION:
+        raise ValueError("Unsupported intid set format version %s" % version)
+    return flags, count
+
+
+def view(buf):
+    """
+    Return a sequence of the intids encoded in the buffer.
+
+    For uncompressed buffers on little endian platforms this is a
+    :class:`memoryview` sharing the buffer's memory, which must stay open
+    for as long as it is used.
+
+    :raises ValueError: If the buffer does not hold an encoded set, or
+        holds fewer or more intids than its header says.
+    """
+    flags, count = read_header(buf)
+    payload = memoryview(buf)[HEADER_SIZE:]
+    if flags & COMPRESSED:
+        values = _decode_deltas(zlib.decompress(payload.tobytes()))
+        if len(values) != count:
+            raise ValueError("Expected %s intids, found %s" % (count, len(values)))
+        return values
+    itemsize = array(_TYPECODE).itemsize
+    payload = payload[:count * itemsize]
+    if len(payload) != count * itemsize:
+        raise ValueError("Expected %s intids, found %s"
+                         % (count, len(payload) // itemsize))
+    if not _SWAP and hasattr(payload, 'cast'):
+        return payload.cast(_TYPECODE)
+    values = array(_TYPECODE)  # pragma: no cover
+    _frombytes(values, payload.tobytes())  # pragma: no cover
+    if _SWAP:  # pragma: no cover
+        values.byteswap()
+    return values  # pragma: no cover
+
+
+def loads(buf, family=BTrees.family64):
+    """
+    Return an :class:`~nti.segments.interfaces.IIntIdSet` of the intids
+    encoded in the buffer.
+    """
+    return IntIdSet(family.IF.Set(view(buf)), family)
+
+
+class MappedIntIds(object):
+    """
+    A context manager memory mapping a file written by :func:`dump`,
+    providing a :func:`view` of its intids while open.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._mapped = None
+        self.intids = None
+
+    def __enter__(self):
+        self._file = open(self.path, 'rb')
+        self._mapped = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.intids = view(self._mapped)
+        return self
+
+    def __exit__(self, *unused_exc_info):
+        if isinstance(self.intids, memoryview):
+            self.intids.release()
+        self.intids = None
+        self._mapped.close()
+        self._file.close()
+
+
+def load_mapped(path):
+    """
+    Return a :class:`MappedIntIds` for the file at ``path``.
+    """
+    return MappedIntIds(path)
@@ -15,7 +15,12 @@ from zope.container.constraints import contains
 from zope.container.interfaces import IContainer
 from zope.container.interfaces import IContained
 
+from zope.interface import Attribute
 from zope.interface import Interface
+from zope.interface import implementer
+
+from zope.interface.interfaces import IObjectEvent
+from zope.interface.interfaces import ObjectEvent
 
 from zope.schema import Object
 
@@ -27,6 +32,7 @@ from nti.coremetadata.interfaces import IShouldHaveTraversablePath
 
 from nti.schema.field import Bool
 from nti.schema.field import IndexedIterable
+from nti.schema.field import Int
 from nti.schema.field import ValidTextLine
 
 
@@ -73,6 +79,11 @@ class IFilterSet(Interface):
         filter set.
         """
 
+    dependencies = Attribute(
+        "A frozenset of the names of the indexes whose contents this filter "
+        "set's results are derived from, or ``None`` if they are unknown, "
+        "in which case any index change is assumed to affect the results.")
+
 
 class IUserFilterSet(IFilterSet):
     """
@@ -85,6 +96,14 @@ def simple_filter_set(filter_set):
             and not IIntersectionUserFilterSet.providedBy(filter_set))
 
 
+def intersected_filter_set(filter_set):
+    # Negations may be intersected directly, sparing "A and not B" from
+    # being rewritten into a union of everything except B.
+    return (IUnionUserFilterSet.providedBy(filter_set)
+            or INotUserFilterSet.providedBy(filter_set)
+            or IDifferenceUserFilterSet.providedBy(filter_set))
+
+
 class IUnionUserFilterSet(IUserFilterSet):
     """
     A filter set containing a list of other filter sets whose result is the
@@ -105,11 +124,41 @@ class IIntersectionUserFilterSet(IUserFilterSet):
     """
 
     filter_sets = IndexedIterable(title=u'Filter Sets',
-                                  description=u'Filter sets whose results will be unioned.',
-                                  value_type=Object(IUnionUserFilterSet),
+                                  description=u'Filter sets whose results will be intersected.',
+                                  value_type=Object(IUserFilterSet,
+                                                    constraint=intersected_filter_set),
                                   min_length=1)
 
 
+class INotUserFilterSet(IUserFilterSet):
+    """
+    A filter set whose result is the members of the initial set that are not
+    in the results of the contained filter set.
+    """
+
+    filter_set = Object(IUserFilterSet,
+                        title=u'Filter Set',
+                        description=u'Filter set whose results will be excluded.',
+                        required=True)
+
+
+class IDifferenceUserFilterSet(IUserFilterSet):
+    """
+    A filter set whose result is the results of one filter set less the
+    results of another.
+    """
+
+    filter_set = Object(IUserFilterSet,
+                        title=u'Filter Set',
+                        description=u'Filter set whose results will be included.',
+                        required=True)
+
+    excluded_filter_set = Object(IUserFilterSet,
+                                 title=u'Excluded Filter Set',
+                                 description=u'Filter set whose results will be excluded.',
+                                 required=True)
+
+
 class IIsDeactivatedFilterSet(IUserFilterSet):
     """
     A filter set describing users with a given deactivation status.
@@ -121,6 +170,153 @@ class IIsDeactivatedFilterSet(IUserFilterSet):
                        default=False)
 
 
+class IMembershipSketch(Interface):
+    """
+    A probabilistic summary of a set of intids, which may report intids
+    not in the set as members but never the reverse.
+    """
+
+    def __contains__(intid):
+        """
+        Whether the intid may be in the set.
+        """
+
+
+class ISegmentResult(Interface):
+    """
+    An immutable snapshot of the evaluated membership of a segment.
+    """
+
+    intids = Attribute("A :mod:`BTrees` set of the intids of the members.")
+
+    sketch = Attribute("An :class:`IMembershipSketch` of the intids, built "
+                       "on first use.")
+
+    size = Attribute("The number of members.")
+
+    lastModified = Attribute("The time at which the result was computed.")
+
+
+class ISegmentMembershipDiff(Interface):
+    """
+    The change in the membership of a segment between two evaluations.
+    """
+
+    added = Attribute("An :class:`IIntIdSet` of the intids that entered the segment.")
+
+    removed = Attribute("An :class:`IIntIdSet` of the intids that left the segment.")
+
+    result = Attribute("The :class:`ISegmentResult` the changes lead to.")
+
+
+class ISegmentMembershipSnapshots(Interface):
+    """
+    The memberships of a segment last seen by each consumer of its
+    changes, stored as an annotation of the segment.
+    """
+
+    def get(consumer, default=None):
+        """
+        Return the :class:`ISegmentResult` last seen by the consumer.
+        """
+
+    def replace(consumer, intids):
+        """
+        Record the intids as the membership seen by the consumer,
+        returning the new :class:`ISegmentResult`.
+        """
+
+    def remove(consumer):
+        """
+        Discard the membership seen by the consumer.
+        """
+
+
+class ISegmentOverlapMatrix(Interface):
+    """
+    The number of members each pair of segments has in common.
+    """
+
+    segment_ids = Attribute("A tuple of the ids of the segments compared.")
+
+    estimated = Attribute("Whether the overlaps are estimates.")
+
+    def overlap(first_id, second_id):
+        """
+        The number of members the two segments have in common; for a
+        segment with itself, its size.
+        """
+
+    def rows():
+        """
+        Return a list of the rows of the full matrix, in the order of
+        :attr:`segment_ids`.
+        """
+
+
+class ISegmentEvaluationStatistics(Interface):
+    """
+    Rolling statistics about the evaluations of a segment.
+    """
+
+    evaluations = Attribute("The number of evaluations recorded.")
+
+    last_size = Attribute("The number of members found by the last evaluation.")
+
+    node_cardinalities = Attribute(
+        "A mapping of the dotted paths of the nodes of the filter set tree "
+        "(the root being the empty string) to the size of their results in "
+        "the last evaluation. Intersected children after the first are "
+        "applied to the result of those before them, so their sizes are "
+        "conditional on the preceding children rather than independent.")
+
+    last_duration = Attribute("The seconds taken by the last evaluation.")
+
+    p95_duration = Attribute("The 95th percentile of the seconds taken by "
+                             "recent evaluations.")
+
+    generation = Attribute("The index generation the last evaluation was "
+                           "computed at, if known. Unless given, the id of "
+                           "the transaction the segment's connection read "
+                           "as of, as an integer.")
+
+    lastModified = Attribute("The time of the last evaluation.")
+
+    def record(size, node_cardinalities, duration, generation=None):
+        """
+        Record an evaluation.
+        """
+
+
+class ISegmentStatisticsStorage(Interface):
+    """
+    The evaluation statistics of the segments of a container, stored as an
+    annotation of the container.
+    """
+
+    def get(segment_id, default=None):
+        """
+        Return the :class:`ISegmentEvaluationStatistics` of the segment.
+        """
+
+    def statistics_for(segment_id):
+        """
+        Return the :class:`ISegmentEvaluationStatistics` of the segment,
+        creating them if needed.
+        """
+
+    def remove(segment_id):
+        """
+        Discard the statistics of the segment.
+        """
+
+    def items():
+        """
+        Return the ``(segment_id, statistics)`` pairs of the segments with
+        statistics.
+        """
+
+
 class ISegment(IContained,
                ICreated,
                ILastModified,
@@ -135,6 +331,30 @@ class ISegment(IContained,
                         title=u"Filter set defining the set of objects.",
                         required=False)
 
+    dirty = Attribute("Whether any index the filter set depends on has "
+                      "changed since the segment's results were last computed. "
+                      "Setting it marks a change, or clears the changes so far.")
+
+    generation = Attribute("A count of the changes to the indexes the filter "
+                           "set depends on.")
+
+    refresh_interval = Int(title=u"Refresh Interval",
+                           description=u"Seconds after which a background refresh "
+                                       u"of the results is due.",
+                           min=1,
+                           required=False)
+
+    result = Attribute("The most recently published :class:`ISegmentResult`, "
+                       "or ``None`` if the segment has not been evaluated.")
+
+    def publish_result(intids, generation=None):
+        """
+        Replace the published result with a new snapshot of the given intids
+        and clear the dirty flag, unless the indexes have changed since the
+        ``generation`` the intids were computed at (by default the current
+        one).
+        """
+
 
 class IUserSegment(ISegment):
     """
@@ -158,8 +378,60 @@ class ISegmentsContainer(IContained,
     def remove(segment):
         pass
 
+    def mark_dirty(names):
+        """
+        Mark as dirty the segments whose filter sets depend on any of the given
+        index names, returning them. Segments already dirty are marked again.
+        """
+
+    def index_dependencies(segment):
+        """
+        Update the record of the indexes the segment depends on, e.g. after
+        its filter set has been replaced.
+        """
+
+    def update_filter_set(segment):
+        """
+        Share the subtrees of the segment's filter set with the other
+        segments, if it has been replaced, releasing those of the tree it
+        replaced, and update the record of the indexes it depends on.
+        """
+
 
 class ISiteSegmentsContainer(ISegmentsContainer):
     """
     Container for storing segments for the site
     """
+
+
+class IIndexesModifiedEvent(Interface):
+    """
+    Fired when the contents of the named indexes have changed, e.g. when
+    an entity has been reindexed.
+    """
+
+    names = Attribute("The names of the modified indexes.")
+
+
+@implementer(IIndexesModifiedEvent)
+class IndexesModifiedEvent(object):
+
+    def __init__(self, names):
+        self.names = frozenset(names)
+
+
+class ISegmentsImportedEvent(IObjectEvent):
+    """
+    Fired for each chunk of a bulk import of segments into a container, in
+    place of the events of adding each one; the object is the container.
+    """
+
+    segments = Attribute("The segments imported in the chunk.")
+
+
+@implementer(ISegmentsImportedEvent)
+class SegmentsImportedEvent(ObjectEvent):
+
+    def __init__(self, container, segments):
+        ObjectEvent.__init__(self, container)
+        self.segments = segments
@@ -8,16 +8,29 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import binascii
+import os
+import time
+
 import BTrees
 
+from BTrees.OIBTree import OIBTree
+
+from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOTreeSet
+
+from persistent import Persistent
+
+import six
+
 from zope import interface
 
+from zope.annotation.interfaces import IAttributeAnnotatable
+
 from zope.app.appsetup.bootstrap import ensureUtility
 
 from zope.container.contained import Contained
 
-from zope.container.interfaces import INameChooser
-
 from nti.containers.containers import CaseInsensitiveCheckingLastModifiedBTreeContainer
 
 from nti.coremetadata.interfaces import IX_IS_DEACTIVATED
@@ -31,17 +44,37 @@ from nti.schema.fieldproperty import createDirectFieldProperties
 
 from nti.schema.schema import SchemaConfigured
 
+from nti.segments.canonical import intern_filter_set
+from nti.segments.canonical import release_filter_set
+
+from nti.segments.conflicts import resolve_state
+
+from nti.segments.evaluation import cached_catalog_read
+from nti.segments.evaluation import cached_result
+from nti.segments.evaluation import checkpoint
+from nti.segments.evaluation import range_slice
+
+from nti.segments.interfaces import IDifferenceUserFilterSet
 from nti.segments.interfaces import IIntersectionUserFilterSet
 from nti.segments.interfaces import IIntIdSet
 from nti.segments.interfaces import IIsDeactivatedFilterSet
+from nti.segments.interfaces import INotUserFilterSet
+from nti.segments.interfaces import ISegment
+from nti.segments.interfaces import ISegmentResult
 from nti.segments.interfaces import ISegmentsContainer
 from nti.segments.interfaces import IUnionUserFilterSet
 from nti.segments.interfaces import IUserSegment
 
+from nti.segments.sketch import BloomFilter
+
 logger = __import__('logging').getLogger(__name__)
 
+#: Modification times, whether kept as numbers or (in ``_lastModified``) as
+#: persistent maximums that resolve their own conflicts
+_TIMESTAMPS = ('lastModified', '_lastModified')
 
-@interface.implementer(IUserSegment)
+
+@interface.implementer(IUserSegment, IAttributeAnnotatable)
 class UserSegment(PersistentCreatedModDateTrackingObject,
                   SchemaConfigured,
                   Contained):
@@ -49,19 +82,169 @@ class UserSegment(PersistentCreatedModDateTrackingObject,
 
     mimeType = mime_type = "application/vnd.nextthought.segments.usersegment"
 
+    #: Counts the changes to the indexes the filter set depends on
+    generation = 0
+
+    #: The generation the published result was computed at; segments start
+    #: out without results, so they need computing
+    result_generation = -1
+
+    result = None
 
-@interface.implementer(ISegmentsContainer)
+    def _get_dirty(self):
+        return self.result_generation < self.generation
+
+    def _set_dirty(self, dirty):
+        if dirty:
+            self.generation += 1
+        else:
+            self.result_generation = self.generation
+
+    dirty = property(_get_dirty, _set_dirty)
+
+    def publish_result(self, intids, generation=None):
+        # Readers hold on to whichever snapshot they fetched, so swapping
+        # in a complete new result is all that's needed to stay consistent.
+        self.result = SegmentResult(intids)
+        # Changes made while the result was computed still need computing
+        generation = self.generation if generation is None else generation
+        self.result_generation = max(self.result_generation, generation)
+        return self.result
+
+    def _p_resolveConflict(self, old, committed, new):
+        # e.g. a refresh publishing a result while the segment is marked
+        # dirty or edited. Concurrent marks each count, and the result is
+        # as current as the latest published.
+        return resolve_state(old, committed, new,
+                             counters=('generation',),
+                             timestamps=_TIMESTAMPS + ('result_generation',))
+
+
+@interface.implementer(ISegmentResult)
+class SegmentResult(Persistent):
+
+    _sketch = None
+
+    def __init__(self, intids, lastModified=None):
+        self.intids = intids
+        self.size = len(intids)
+        self.lastModified = time.time() if lastModified is None else lastModified
+
+    @property
+    def sketch(self):
+        # Built on first use rather than when publishing, and stored in its
+        # own record so reading the size doesn't load it. The intids never
+        # change, so it can never be out of date.
+        if self._sketch is None:
+            self._sketch = BloomFilter.from_intids(self.intids)
+        return self._sketch
+
+    def _p_resolveConflict(self, unused_old, committed, unused_new):
+        # The only change after creation is building the sketch, and
+        # concurrently built ones are of the same intids
+        return committed
+
+
+def allocate_segment_id(container):
+    """
+    Return a new random 64-bit id, as lowercase hex, not used in the
+    container.
+
+    Unlike the name chooser this needs only one membership check in all but
+    astronomically rare cases, and random ids spread concurrent inserts over
+    the container's BTree buckets rather than all landing in the last one.
+    The ids are already lowercase, so they are unchanged by the container's
+    case-insensitive keys, and the check is a lookup of a plain string.
+    """
+    while True:
+        # Not the random module, whose state is copied into forked workers
+        result = binascii.hexlify(os.urandom(8)).decode('ascii')
+        if result not in container:
+            return result
+
+
+@interface.implementer(ISegmentsContainer, IAttributeAnnotatable)
 class SegmentsContainer(CaseInsensitiveCheckingLastModifiedBTreeContainer,
                         Contained):
 
     createDirectFieldProperties(ISegmentsContainer)
 
+    #: Canonical keys to the filter set trees shared by the segments
+    _filter_sets = None
+
+    #: Canonical keys to the number of uses of the shared filter sets
+    _filter_set_counts = None
+
+    #: Index names to the ids of the segments depending on them
+    _dependents = None
+
+    #: The ids of the segments whose dependencies are unknown
+    _unknown_dependents = None
+
+    #: The ids of the segments to the filter set trees interned for them
+    _interned = None
+
+    #: The lowercased ids of the segments to the segments. Looking them up
+    #: compares plain strings, rather than the case-insensitive key objects
+    #: of the container, which are created for every lookup and compared
+    #: in Python.
+    _by_id = None
+
+    def __init__(self):
+        super(SegmentsContainer, self).__init__()
+        # Created up front, so concurrent first adds don't conflict on them
+        self._filter_sets = OOBTree()
+        self._filter_set_counts = OIBTree()
+        self._dependents = OOBTree()
+        self._unknown_dependents = OOTreeSet()
+        self._interned = OOBTree()
+        self._by_id = OOBTree()
+
+    def _p_resolveConflict(self, old, committed, new):
+        # Adds and removes write the contents' own BTrees; the container's
+        # state itself only changes when an attribute is replaced
+        return resolve_state(old, committed, new, timestamps=_TIMESTAMPS)
+
+    def intern_filter_set(self, filter_set):
+        if self._filter_sets is None:
+            self._filter_sets = OOBTree()
+        if self._filter_set_counts is None:
+            self._filter_set_counts = OIBTree()
+        return intern_filter_set(filter_set, self._filter_sets,
+                                 self._filter_set_counts)
+
+    def _intern_segment(self, segment_id, segment):
+        # Records the tree interned, so what was counted is released even
+        # once the segment's filter set has been replaced
+        if self._interned is None:
+            self._interned = OOBTree()
+        if segment.filter_set is not None:
+            segment.filter_set = self.intern_filter_set(segment.filter_set)
+            self._interned[segment_id] = segment.filter_set
+
+    def _release_segment(self, segment_id):
+        interned = self._interned.pop(segment_id, None) \
+            if self._interned is not None else None
+        if interned is not None and self._filter_set_counts is not None:
+            release_filter_set(interned, self._filter_sets, self._filter_set_counts)
+
     def add(self, segment):
         if not getattr(segment, 'id', None):
-            segment.id = INameChooser(self).chooseName('', segment)
+            segment.id = allocate_segment_id(self)
+        if ISegment.providedBy(segment):
+            self._intern_segment(segment.id, segment)
         self[segment.id] = segment
         return segment
 
+    def update_filter_set(self, segment):
+        segment_id = segment.__name__
+        interned = self._interned.get(segment_id) if self._interned is not None else None
+        if segment.filter_set is not interned:
+            # Replaced; releasing and interning an equal tree balances out
+            self._release_segment(segment_id)
+            self._intern_segment(segment_id, segment)
+        self.index_dependencies(segment)
+
     def remove(self, segment):
         key = getattr(segment, 'id', segment)
         try:
@@ -71,6 +254,96 @@ class SegmentsContainer(CaseInsensitiveCheckingLastModifiedBTreeContainer,
             result = False
         return result
 
+    def _dependency_index(self):
+        if self._dependents is None:
+            # Containers from before dependencies were indexed
+            self._dependents = OOBTree()
+            self._unknown_dependents = OOTreeSet()
+            for name, segment in self.items():
+                self._index(name, segment)
+        return self._dependents, self._unknown_dependents
+
+    def _unindex(self, segment_id):
+        dependents, unknown = self._dependency_index()
+        if segment_id in unknown:
+            unknown.remove(segment_id)
+        for name in list(dependents.keys()):
+            ids = dependents[name]
+            if segment_id in ids:
+                ids.remove(segment_id)
+                if not ids:
+                    del dependents[name]
+
+    def _index(self, segment_id, segment):
+        dependents, unknown = self._dependency_index()
+        dependencies = filter_set_dependencies(getattr(segment, 'filter_set', None))
+        if dependencies is None:
+            unknown.add(segment_id)
+            return
+        for name in dependencies:
+            ids = dependents.get(name)
+            if ids is None:
+                ids = dependents[name] = OOTreeSet()
+            ids.add(segment_id)
+
+    def index_dependencies(self, segment):
+        self._unindex(segment.__name__)
+        self._index(segment.__name__, segment)
+
+    def _indexed_by_id(self, key):
+        # Containers from before ids were indexed use the container's keys
+        return self._by_id is not None and isinstance(key, six.string_types)
+
+    def __contains__(self, key):
+        if self._indexed_by_id(key):
+            return key.lower() in self._by_id
+        return super(SegmentsContainer, self).__contains__(key)
+
+    def __getitem__(self, key):
+        if self._indexed_by_id(key):
+            return self._by_id[key.lower()]
+        return super(SegmentsContainer, self).__getitem__(key)
+
+    def get(self, key, default=None):
+        if self._indexed_by_id(key):
+            return self._by_id.get(key.lower(), default)
+        return super(SegmentsContainer, self).get(key, default)
+
+    # Every way of adding or removing segments goes through these
+
+    def _setitemf(self, key, value):
+        super(SegmentsContainer, self)._setitemf(key, value)
+        if self._by_id is not None:
+            self._by_id[key.lower()] = value
+        if ISegment.providedBy(value):
+            self._index(key, value)
+
+    def __delitem__(self, key):
+        segment = self.get(key)
+        super(SegmentsContainer, self).__delitem__(key)
+        if self._by_id is not None:
+            self._by_id.pop(key.lower(), None)
+        if segment is not None:
+            segment_id = getattr(segment, '__name__', None) or key
+            self._unindex(segment_id)
+            self._release_segment(segment_id)
+
+    def mark_dirty(self, names):
+        dependents, unknown = self._dependency_index()
+        affected = set(unknown)
+        for name in names:
+            affected.update(dependents.get(name, ()))
+        result = []
+        for segment_id in sorted(affected):
+            segment = self.get(segment_id)
+            if segment is None:
+                continue
+            # Marked even when already dirty, so a result being computed
+            # concurrently, from before this change, doesn't clear it
+            segment.dirty = True
+            result.append(segment)
+        return result
+
 
 def install_segments_container(site_manager_container):
     return ensureUtility(site_manager_container,
@@ -79,6 +352,26 @@ def install_segments_container(site_manager_container):
                          SegmentsContainer)
 
 
+def filter_set_dependencies(filter_set):
+    """
+    Return a frozenset of the index names the given filter set depends on,
+    or ``None`` if those can't be determined.
+    """
+    if filter_set is None:
+        return frozenset()
+    return getattr(filter_set, 'dependencies', None)
+
+
+def _combined_dependencies(filter_sets):
+    result = set()
+    for filter_set in filter_sets:
+        dependencies = filter_set_dependencies(filter_set)
+        if dependencies is None:
+            return None
+        result.update(dependencies)
+    return frozenset(result)
+
+
 def _to_intids(result_set):
     if not hasattr(result_set, 'intids'):
         return result_set
@@ -93,59 +386,111 @@ class IntIdSet(object):
         self.family = family
         self._intids = intids
 
+    def __len__(self):
+        return len(self._intids)
+
     def intids(self):
         return self._intids
 
     def intersection(self, result_set):
         other_ids = _to_intids(result_set)
-        return IntIdSet(self.family.IF.intersection(self._intids, other_ids))
+        return IntIdSet(self.family.IF.intersection(self._intids, other_ids), self.family)
 
     def union(self, result_set):
         other_ids = _to_intids(result_set)
-        return IntIdSet(self.family.IF.union(self._intids, other_ids))
+        return IntIdSet(self.family.IF.union(self._intids, other_ids), self.family)
 
     def difference(self, result_set):
         other_ids = _to_intids(result_set)
-        return IntIdSet(self.family.IF.difference(self._intids, other_ids))
+        return IntIdSet(self.family.IF.difference(self._intids, other_ids), self.family)
 
 
 @interface.implementer(IUnionUserFilterSet)
-class UnionUserFilterSet(SchemaConfigured):
+class UnionUserFilterSet(Persistent, SchemaConfigured):
 
     createDirectFieldProperties(IUnionUserFilterSet)
 
     mimeType = mime_type = "application/vnd.nextthought.segments.unionuserfilterset"
 
+    @property
+    def dependencies(self):
+        return _combined_dependencies(self.filter_sets)
+
     def apply(self, initial_set):
-        result = self.filter_sets[0].apply(initial_set)
+        result = cached_result(self.filter_sets[0], initial_set)
         for filter_set in self.filter_sets[1:]:
-            result = result.union(filter_set.apply(initial_set))
+            checkpoint(self, result)
+            result = result.union(cached_result(filter_set, initial_set))
 
         return result
 
 
 @interface.implementer(IIntersectionUserFilterSet)
-class IntersectionUserFilterSet(SchemaConfigured):
+class IntersectionUserFilterSet(Persistent, SchemaConfigured):
 
     createDirectFieldProperties(IIntersectionUserFilterSet)
 
     mimeType = mime_type = "application/vnd.nextthought.segments.intersectionuserfilterset"
 
+    @property
+    def dependencies(self):
+        return _combined_dependencies(self.filter_sets)
+
     def apply(self, initial_set):
-        result = self.filter_sets[0].apply(initial_set)
+        result = cached_result(self.filter_sets[0], initial_set)
         for filter_set in self.filter_sets[1:]:
-            result = result.intersection(filter_set.apply(result))
+            checkpoint(self, result)
+            if INotUserFilterSet.providedBy(filter_set):
+                # Already a subset of what it was given
+                result = cached_result(filter_set, result)
+            else:
+                result = result.intersection(cached_result(filter_set, result))
 
         return result
 
 
+@interface.implementer(INotUserFilterSet)
+class NotUserFilterSet(Persistent, SchemaConfigured):
+
+    createDirectFieldProperties(INotUserFilterSet)
+
+    mimeType = mime_type = "application/vnd.nextthought.segments.notuserfilterset"
+
+    @property
+    def dependencies(self):
+        return filter_set_dependencies(self.filter_set)
+
+    def apply(self, initial_set):
+        return initial_set.difference(cached_result(self.filter_set, initial_set))
+
+
+@interface.implementer(IDifferenceUserFilterSet)
+class DifferenceUserFilterSet(Persistent, SchemaConfigured):
+
+    createDirectFieldProperties(IDifferenceUserFilterSet)
+
+    mimeType = mime_type = "application/vnd.nextthought.segments.differenceuserfilterset"
+
+    @property
+    def dependencies(self):
+        return _combined_dependencies((self.filter_set, self.excluded_filter_set))
+
+    def apply(self, initial_set):
+        result = cached_result(self.filter_set, initial_set)
+        checkpoint(self, result)
+        # Only what's left needs checking against the exclusion
+        return result.difference(cached_result(self.excluded_filter_set, result))
+
+
 @interface.implementer(IIsDeactivatedFilterSet)
-class IsDeactivatedFilterSet(SchemaConfigured):
+class IsDeactivatedFilterSet(Persistent, SchemaConfigured):
 
     createDirectFieldProperties(IIsDeactivatedFilterSet)
 
     mimeType = mime_type = "application/vnd.nextthought.segments.isdeactivatedfilterset"
 
+    dependencies = frozenset((IX_IS_DEACTIVATED,))
+
     def __init__(self, **kwargs):
         SchemaConfigured.__init__(self, **kwargs)
 
@@ -153,12 +498,16 @@ class IsDeactivatedFilterSet(SchemaConfigured):
     def entity_catalog(self):
         return get_entity_catalog()
 
+    def _read_deactivated_intids(self, catalog):
+        deactivated_idx = catalog[IX_TOPICS][IX_IS_DEACTIVATED]
+        ids = deactivated_idx.getIds()
+        return catalog.family.IF.Set(range_slice(ids) if ids else ())
+
     @property
     def deactivated_intids(self):
-        deactivated_idx = self.entity_catalog[IX_TOPICS][IX_IS_DEACTIVATED]
-        deactivated_ids = self.entity_catalog.family.IF.Set(deactivated_idx.getIds() or ())
-
-        return deactivated_ids
+        catalog = self.entity_catalog
+        return cached_catalog_read((id(catalog), IX_TOPICS, IX_IS_DEACTIVATED),
+                                   lambda: self._read_deactivated_intids(catalog))
 
     def apply(self, initial_set):
         if self.Deactivated:
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Pairwise overlaps between the segments of a site.
+
+Each segment is evaluated once; the overlaps are then the sizes of the
+intersections of the results, computed by the :mod:`BTrees` merge of their
+sorted intids, or estimated from bottom-k MinHash sketches when there are
+many segments.
+
+.. $Id$
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import heapq
+
+from array import array
+
+import BTrees
+
+from zope import interface
+
+from nti.segments.evaluation import evaluate_segments
+
+from nti.segments.interfaces import ISegmentOverlapMatrix
+
+from nti.segments.model import _to_intids
+
+from nti.segments.sketch import mix
+
+logger = __import__('logging').getLogger(__name__)
+
+#: A suggested number of hashes kept in MinHash sketches; the error of the
+#: estimated Jaccard similarity is about ``1 / sqrt(sketch_size)``
+DEFAULT_SKETCH_SIZE = 128
+
+
+def _index(i, j, count):
+    # Position of (i, j), i <= j, in the row-major upper triangle
+    return i * count - i * (i - 1) // 2 + (j - i)
+
+
+@interface.implementer(ISegmentOverlapMatrix)
+class SegmentOverlapMatrix(object):
+    """
+    A symmetric overlap matrix, storing only its upper triangle.
+    """
+
+    def __init__(self, segment_ids, overlaps, estimated=False):
+        self.segment_ids = tuple(segment_ids)
+        self.estimated = estimated
+        self._positions = dict((x, i) for i, x in enumerate(self.segment_ids))
+        self._overlaps = overlaps
+
+    def overlap(self, first_id, second_id):
+        i = self._positions[first_id]
+        j = self._positions[second_id]
+        if i > j:
+            i, j = j, i
+        return self._overlaps[_index(i, j, len(self.segment_ids))]
+
+    def rows(self):
+        ids = self.segment_ids
+        return [[self.overlap(x, y) for y in ids] for x in ids]
+
+
+def _sketch(intids, sketch_size):
+    # The smallest hashes of the members, hashing each intid once
+    return frozenset(heapq.nsmallest(sketch_size, map(mix, intids)))
+
+
+def _estimated_overlap(first, second, first_size, second_size, sketch_size):
+    if not first_size or not second_size:
+        return 0
+    # The smallest hashes of the union are a uniform sample of it; the
+    # fraction of them in both sketches estimates the Jaccard similarity
+    smallest = heapq.nsmallest(sketch_size, first.union(second))
+    matches = sum(1 for x in smallest if x in first and x in second)
+    jaccard = matches / len(smallest)
+    # |A & B| = J * |A | B| = J * (|A| + |B|) / (1 + J)
+    return int(round(jaccard * (first_size + second_size) / (1 + jaccard)))
+
+
+def overlap_matrix(segments, initial_set, sketch_size=None):
+    """
+    Compute the overlaps between every pair of the segments (with filter
+    sets), evaluated against the initial set.
+
+    :param sketch_size: If given, estimate the overlaps from bottom-k
+        MinHash sketches keeping this many hashes rather than computing
+        them exactly; worthwhile for hundreds of segments with large
+        results.
+    :return: An :class:`~nti.segments.interfaces.ISegmentOverlapMatrix`.
+    """
+    segments = [x for x in segments if x.filter_set is not None]
+    results = evaluate_segments(segments, initial_set)
+    segment_ids = [x.id for x in segments]
+    family = getattr(initial_set, 'family', BTrees.family64)
+    intids = [_to_intids(results[x]) for x in segment_ids]
+    sizes = [len(x) for x in intids]
+    count = len(segment_ids)
+    overlaps = array('q', [0]) * (count * (count + 1) // 2)
+    if sketch_size:
+        sketches = [_sketch(x, sketch_size) for x in intids]
+    for i in range(count):
+        overlaps[_index(i, i, count)] = sizes[i]
+        for j in range(i + 1, count):
+            if sketch_size:
+                value = _estimated_overlap(sketches[i], sketches[j],
+                                           sizes[i], sizes[j], sketch_size)
+            else:
+                value = len(family.IF.intersection(intids[i], intids[j]))
+            overlaps[_index(i, j, count)] = value
+    return SegmentOverlapMatrix(segment_ids, overlaps, estimated=bool(sketch_size))
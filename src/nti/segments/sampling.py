@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Limited evaluations of filter sets, for spot checking a few members of a
+segment without evaluating it over the whole population.
+
+The filter set tree is applied to successively larger chunks of the
+population, stopping as soon as enough members have been found. As with
+sharded evaluation this relies on filter sets selecting members of the
+population independently of each other. Index contents read by the leaves
+are shared across the chunks.
+
+.. $Id$
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import itertools
+import random
+
+from array import array
+
+import BTrees
+
+from nti.segments.evaluation import cached_catalog_read
+from nti.segments.evaluation import checkpoint
+from nti.segments.evaluation import current_evaluation
+from nti.segments.evaluation import evaluation
+
+from nti.segments.model import IntIdSet
+from nti.segments.model import _to_intids
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The size of the first chunk evaluated; each further chunk is twice as big
+DEFAULT_CHUNK_SIZE = 256
+
+#: The largest chunk evaluated at once
+MAX_CHUNK_SIZE = 65536
+
+_TYPECODE = 'q'
+
+
+def _chunk_sizes(chunk_size):
+    while True:
+        yield chunk_size
+        chunk_size = min(chunk_size * 2, max(MAX_CHUNK_SIZE, chunk_size))
+
+
+def _in_order(intids, chunk_size):
+    remaining = iter(intids)
+    for size in _chunk_sizes(chunk_size):
+        chunk = list(itertools.islice(remaining, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def _population(intids):
+    # Copied once per evaluation, so samples taken within the same one
+    # share the copy. Only as long as that: the set may be changed in
+    # place by later transactions. Keeping the set with its copy keeps its
+    # id from being reused meanwhile.
+    return cached_catalog_read((_population, id(intids)),
+                               lambda: (intids, array(_TYPECODE, intids)))[1]
+
+
+def _shuffled(intids, chunk_size, rng):
+    # A Fisher-Yates shuffle of the positions in the population, keeping
+    # only the positions swapped so far, so only as much of the population
+    # is shuffled (and read) as is drawn
+    population = _population(intids)
+    count = len(population)
+    swapped = {}
+    drawn = 0
+    for size in _chunk_sizes(chunk_size):
+        if drawn >= count:
+            break
+        end = min(drawn + size, count)
+        chunk = []
+        for i in range(drawn, end):
+            j = rng.randint(i, count - 1)
+            chunk.append(population[swapped.get(j, j)])
+            swapped[j] = swapped.pop(i, i)
+        yield chunk
+        drawn = end
+
+
+def _collect(filter_set, initial_set, chunks, count):
+    family = getattr(initial_set, 'family', BTrees.family64)
+    found = family.IF.Set()
+    with evaluation(current_evaluation()):
+        for chunk in chunks:
+            chunk = IntIdSet(family.IF.Set(chunk), family)
+            members = family.IF.intersection(_to_intids(filter_set.apply(chunk)),
+                                             chunk.intids())
+            found = family.IF.union(found, members)
+            if len(found) >= count:
+                break
+            checkpoint(filter_set)
+    return found, family
+
+
+def first_members(filter_set, initial_set, limit, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Return an :class:`~nti.segments.interfaces.IIntIdSet` of the (at most)
+    ``limit`` lowest intids of the initial set selected by the filter set.
+    """
+    found, family = _collect(filter_set, initial_set,
+                             _in_order(_to_intids(initial_set), chunk_size), limit)
+    return IntIdSet(family.IF.Set(itertools.islice(found, limit)), family)
+
+
+def sample_members(filter_set, initial_set, count,
+                   chunk_size=DEFAULT_CHUNK_SIZE, rng=random):
+    """
+    Return an :class:`~nti.segments.interfaces.IIntIdSet` of (at most)
+    ``count`` members of the initial set selected by the filter set, chosen
+    uniformly at random.
+    """
+    found, family = _collect(filter_set, initial_set,
+                             _shuffled(_to_intids(initial_set), chunk_size, rng),
+                             count)
+    found = list(found)
+    if len(found) > count:
+        found = rng.sample(found, count)
+    return IntIdSet(family.IF.Set(found), family)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Background refreshing of segment results.
+
+.. $Id$
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+
+from six.moves import queue
+
+from nti.segments.stats import evaluate_with_statistics
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The CPU clock used to enforce the per-cycle budget; only the time spent
+#: by the refreshing thread itself counts, where the platform supports it.
+_cpu_time = (getattr(time, 'thread_time', None)
+             or getattr(time, 'process_time', None)
+             or time.clock)  # pylint: disable=no-member
+
+
+def _run_directly(func):
+    return func()
+
+
+class SegmentRefreshScheduler(object):
+    """
+    Periodically re-evaluates the segments of a set of
+    :class:`~nti.segments.interfaces.ISegmentsContainer` objects in a
+    worker thread, publishing each new result on the segment.
+
+    Segments are due for a refresh when they are dirty, when their
+    ``refresh_interval`` (or the scheduler's ``default_interval``) has
+    elapsed, or when a result has been requested through :meth:`request`.
+    Due segments are refreshed in order of demand and staleness until the
+    ``cycle_budget`` of CPU seconds has been used; the rest wait for the
+    next cycle.
+
+    :param containers: A callable returning a mapping of keys (e.g. site
+        names) to segment containers.
+    :param population: A callable taking a container key and returning the
+        :class:`~nti.segments.interfaces.IIntIdSet` filter sets are applied to.
+    :param cycle_runner: A callable invoked with a function running one
+        cycle, e.g. to run it within a transaction and site; it must return
+        that function's result.
+    """
+
+    default_interval = 3600
+    cycle_budget = 5.0
+    poll_interval = 30
+
+    def __init__(self, containers, population,
+                 default_interval=None,
+                 cycle_budget=None,
+                 poll_interval=None,
+                 cycle_runner=_run_directly):
+        self.containers = containers
+        self.population = population
+        self.cycle_runner = cycle_runner
+        if default_interval is not None:
+            self.default_interval = default_interval
+        if cycle_budget is not None:
+            self.cycle_budget = cycle_budget
+        if poll_interval is not None:
+            self.poll_interval = poll_interval
+        self._demand = {}
+        self._requests = queue.Queue()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def request(self, key, segment_id):
+        """
+        Note a request for the results of the segment identified by the
+        container key and segment id, raising its priority. Safe to call
+        from any thread.
+        """
+        self._requests.put((key, segment_id))
+
+    def _drain_requests(self):
+        while True:
+            try:
+                request = self._requests.get_nowait()
+            except queue.Empty:
+                break
+            self._demand[request] = self._demand.get(request, 0) + 1
+
+    def priority(self, segment, demand, now):
+        """
+        Return the priority of refreshing the segment, or ``None`` if it is
+        not due. Higher values are refreshed first.
+        """
+        result = segment.result
+        if result is None:
+            return float('inf')
+        interval = segment.refresh_interval or self.default_interval
+        staleness = (now - result.lastModified) / interval
+        if not (segment.dirty or demand or staleness >= 1):
+            return None
+        return staleness + demand + (1 if segment.dirty else 0)
+
+    def _due(self, now):
+        result = []
+        for key, container in self.containers().items():
+            for segment in container.values():
+                if segment.filter_set is None:
+                    continue
+                demand = self._demand.get((key, segment.id), 0)
+                priority = self.priority(segment, demand, now)
+                if priority is not None:
+                    result.append((priority, key, segment))
+        result.sort(key=lambda x: x[0], reverse=True)
+        return result
+
+    def _refresh(self, key, segment):
+        population = self.population(key)
+        generation = segment.generation
+        intids = evaluate_with_statistics(segment, population).intids()
+        segment.publish_result(intids, generation)
+        self._demand.pop((key, segment.id), None)
+
+    def _cycle(self):
+        self._drain_requests()
+        start = _cpu_time()
+        refreshed = []
+        for _, key, segment in self._due(time.time()):
+            if _cpu_time() - start >= self.cycle_budget:
+                break
+            try:
+                self._refresh(key, segment)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Failed to refresh segment %s", segment.id)
+            else:
+                refreshed.append(segment)
+        return refreshed
+
+    def run_cycle(self):
+        """
+        Refresh due segments in the calling thread, returning those
+        refreshed.
+        """
+        return self.cycle_runner(self._cycle)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.run_cycle()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Failed to run segment refresh cycle")
+            self._stopped.wait(self.poll_interval)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='SegmentRefreshScheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Evaluation of filter sets split across worker processes by intid range.
+
+The population is split into contiguous intid ranges, each worker applies
+the whole filter set tree to its range, and the disjoint partial results
+are concatenated. This relies on filter sets selecting members of the
+population independently of each other, which all the filter sets here
+do; results are limited to the population. Each shard is evaluated with
+its range set on the :class:`~nti.segments.evaluation.EvaluationContext`,
+so leaves read only their slice of the indexes (see
+:func:`~nti.segments.evaluation.range_slice`).
+
+Leaves that read the database need a connection and site in the worker
+processes; pass an ``initializer`` setting those up.
+
+.. $Id$
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import itertools
+import multiprocessing
+
+from collections import deque
+
+from concurrent.futures import ProcessPoolExecutor
+
+import BTrees
+
+from nti.segments.evaluation import EvaluationContext
+from nti.segments.evaluation import evaluation
+
+from nti.segments.interchange import dumps
+from nti.segments.interchange import loads
+from nti.segments.interchange import view
+
+from nti.segments.model import IntIdSet
+from nti.segments.model import _to_intids
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def shard_ranges(intids, shards):
+    """
+    Split a :mod:`BTrees` set of intids into at most ``shards`` contiguous
+    ranges of roughly equal size.
+
+    :return: A list of inclusive ``(min, max)`` tuples.
+    """
+    count = len(intids)
+    if not count:
+        return []
+    size = -(-count // max(shards, 1))
+    result = []
+    remaining = iter(intids)
+    for first in remaining:
+        # Skip to the last intid of the shard without a Python level loop
+        last = deque(itertools.islice(remaining, size - 1), maxlen=1)
+        result.append((first, last[0] if last else first))
+    return result
+
+
+#: The initializers already run in this (worker) process
+_initialized = set()
+
+
+def _initialize(initializer, initargs):
+    # Not the executor's own initializer argument, which needs Python 3.7
+    key = (initializer.__module__, initializer.__name__, repr(initargs))
+    if key not in _initialized:
+        initializer(*initargs)
+        _initialized.add(key)
+
+
+def _evaluate_shard(filter_set, buf, family, intid_range,
+                    initializer=None, initargs=()):
+    if initializer is not None:
+        _initialize(initializer, initargs)
+    shard = loads(buf, family)
+    with evaluation(EvaluationContext(intid_range=intid_range)):
+        result = _to_intids(filter_set.apply(shard))
+    return dumps(family.IF.intersection(result, shard.intids()))
+
+
+def evaluate_sharded(filter_set, initial_set, shards=None, executor=None,
+                     initializer=None, initargs=()):
+    """
+    Apply the filter set to the initial set in ``shards`` pieces (by default
+    one per CPU).
+
+    :param executor: A :class:`concurrent.futures.Executor` to run the
+        shards with. By default a new process pool is used for the call.
+    :param initializer: A (picklable) callable run with ``initargs`` once
+        in each worker before its first shard, e.g. to open a database
+        connection and set the site the filter sets read from.
+    :return: An :class:`~nti.segments.interfaces.IIntIdSet`.
+    """
+    family = getattr(initial_set, 'family', BTrees.family64)
+    intids = _to_intids(initial_set)
+    ranges = shard_ranges(intids, shards or multiprocessing.cpu_count())
+    owned = executor is None
+    if owned:
+        executor = ProcessPoolExecutor(max_workers=max(len(ranges), 1))
+    try:
+        # Shards and their results travel in the interchange format
+        futures = [executor.submit(_evaluate_shard, filter_set,
+                                   dumps(intids.keys(low, high)), family,
+                                   (low, high), initializer, tuple(initargs))
+                   for low, high in ranges]
+        parts = [view(future.result()) for future in futures]
+    finally:
+        if owned:
+            executor.shutdown()
+    # The shards are disjoint and ordered, so this is a concatenation
+    return IntIdSet(family.IF.Set(itertools.chain.from_iterable(parts)), family)
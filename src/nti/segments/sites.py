@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Evaluation of the segments of many sites in a single pass.
+
+.. $Id$
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from nti.segments.evaluation import evaluation
+
+from nti.segments.interfaces import ISegmentsContainer
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def partition_population(population, site_members):
+    """
+    Split the population into the members of each site.
+
+    :param population: The :class:`~nti.segments.interfaces.IIntIdSet`
+        population spanning all sites.
+    :param site_members: A mapping of site names to :mod:`BTrees` sets of
+        the intids belonging to each site.
+    :return: A mapping of site names to :class:`~nti.segments.interfaces.IIntIdSet`.
+    """
+    return dict((name, population.intersection(members))
+                for name, members in site_members.items())
+
+
+def _local_container(site):
+    # Not one inherited from a base site, whose segments are evaluated for
+    # that site's population
+    return site.getSiteManager().utilities.registered((), ISegmentsContainer)
+
+
+def evaluate_sites(sites, population, site_members):
+    """
+    Evaluate the segments of all the given sites in one pass.
+
+    The population is partitioned by site once, and entity catalog reads
+    are shared by the filter sets of every site rather than repeated per
+    segment.
+
+    :param sites: Iterable of site objects whose segments to evaluate;
+        only the containers registered in each site itself are evaluated.
+    :param population: The :class:`~nti.segments.interfaces.IIntIdSet`
+        population spanning all sites.
+    :param site_members: A mapping of site names to :mod:`BTrees` sets of
+        the intids belonging to each site; sites missing from it have an
+        empty population.
+    :return: A mapping of site names to mappings of segment ids to
+        :class:`~nti.segments.interfaces.IIntIdSet` results.
+    """
+    partitions = partition_population(population, site_members)
+    result = {}
+    with evaluation():
+        for site in sites:
+            container = _local_container(site)
+            if container is None:
+                continue
+            site_population = partitions.get(site.__name__)
+            if site_population is None:
+                site_population = partitions[site.__name__] = \
+                    population.difference(population)
+            site_result = result[site.__name__] = {}
+            for segment in container.values():
+                if segment.filter_set is not None:
+                    site_result[segment.id] = segment.filter_set.apply(site_population)
+    return result
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Probabilistic summaries of segment membership, for quickly ruling out the
+segments an entity can't be a member of.
+
+.. $Id$
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import math
+
+from persistent import Persistent
+
+from zope import interface
+
+from nti.segments.interfaces import IMembershipSketch
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The largest value returned by :func:`mix`
+MASK = (1 << 64) - 1
+
+
+def mix(intid):
+    """
+    Return a well scattered unsigned 64-bit hash of the intid.
+
+    This is the splitmix64 finalizer, a bijection of 64-bit integers;
+    intids are often sequential, so they need scattering before being used
+    as bit positions or compared as hashes.
+    """
+    x = (intid + 0x9E3779B97F4A7C15) & MASK
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK
+    return x ^ (x >> 31)
+
+
+@interface.implementer(IMembershipSketch)
+class BloomFilter(Persistent):
+    """
+    A Bloom filter of intids sized for ``capacity`` members with a false
+    positive rate of ``error_rate``.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = max(int(math.ceil(-capacity * math.log(error_rate)
+                                      / (math.log(2) ** 2))), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    @classmethod
+    def from_intids(cls, intids, error_rate=0.01):
+        result = cls(len(intids), error_rate)
+        for intid in intids:
+            result.add(intid)
+        return result
+
+    def _positions(self, intid):
+        # Double hashing: k positions from two halves of one 64-bit hash
+        mixed = mix(intid & MASK)
+        first = mixed & 0xFFFFFFFF
+        second = (mixed >> 32) | 1
+        size = self.size
+        for i in range(self.hashes):
+            yield (first + i * second) % size
+
+    def add(self, intid):
+        bits = self.bits
+        for position in self._positions(intid):
+            bits[position >> 3] |= 1 << (position & 7)
+        self._p_changed = True
+
+    def __contains__(self, intid):
+        bits = self.bits
+        for position in self._positions(intid):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+def candidate_segments(segments, intid):
+    """
+    Return the segments whose published results might contain the intid
+    according to their sketches. Segments without results are excluded;
+    those whose results have no sketch are included.
+    """
+    result = []
+    for segment in segments:
+        published = segment.result
+        if published is None:
+            continue
+        sketch = getattr(published, 'sketch', None)
+        if sketch is None or intid in sketch:
+            result.append(segment)
+    return result
+
+
+def segments_containing(segments, intid):
+    """
+    Return the segments whose published results contain the intid, only
+    checking the exact results of the candidates ruled in by the sketches.
+    """
+    return [segment for segment in candidate_segments(segments, intid)
+            if intid in segment.result.intids]
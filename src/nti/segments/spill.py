@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Memory bounded evaluation of filter sets.
+
+Intermediate results are kept as sorted arrays of 64-bit intids; any larger
+than the memory budget are spilled to memory mapped temporary files. Set
+operations stream through their inputs, and as the combinator filter sets
+replace their running result with each new one, inputs are released (and
+their files removed) as soon as they have been consumed.
+
+.. $Id$
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import mmap
+import tempfile
+
+from array import array
+
+import BTrees
+
+from zope import interface
+
+from nti.segments.interfaces import IIntIdSet
+
+from nti.segments.model import _to_intids
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The default number of bytes an intermediate result may keep in memory
+DEFAULT_BUDGET = 64 * 1024 * 1024
+
+_TYPECODE = 'q'
+_ITEMSIZE = array(_TYPECODE).itemsize
+_CHUNK_SIZE = 64 * 1024
+
+_frombytes = getattr(array, 'frombytes', None) or array.fromstring  # pylint: disable=no-member
+
+
+class _Writer(object):
+    """
+    Accumulates sorted intids, moving them to a temporary file once there
+    are more than fit the budget.
+    """
+
+    def __init__(self, budget, tempdir):
+        self._limit = max(budget // _ITEMSIZE, 1)
+        self._tempdir = tempdir
+        self._buffer = array(_TYPECODE)
+        self._file = None
+
+    def extend(self, intids):
+        buf = self._buffer
+        limit = self._limit
+        for intid in intids:
+            buf.append(intid)
+            if len(buf) >= limit:
+                self._spill()
+                buf = self._buffer
+
+    def _spill(self):
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(dir=self._tempdir)
+        self._buffer.tofile(self._file)
+        self._buffer = array(_TYPECODE)
+
+    def close(self):
+        """
+        Return the in memory array, or the file and its memory map.
+        """
+        if self._file is None:
+            return self._buffer, None, None
+        self._spill()
+        self._file.flush()
+        mapped = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return None, self._file, mapped
+
+
+def _merge(left, right, left_only, both, right_only):
+    """
+    Merge two sorted iterables of unique intids, yielding those found only
+    in the left, in both or only in the right as requested.
+    """
+    left = iter(left)
+    right = iter(right)
+    a = next(left, None)
+    b = next(right, None)
+    while a is not None and b is not None:
+        if a < b:
+            if left_only:
+                yield a
+            a = next(left, None)
+        elif b < a:
+            if right_only:
+                yield b
+            b = next(right, None)
+        else:
+            if both:
+                yield a
+            a = next(left, None)
+            b = next(right, None)
+    if left_only and a is not None:
+        yield a
+        for a in left:
+            yield a
+    if right_only and b is not None:
+        yield b
+        for b in right:
+            yield b
+
+
+def _sorted_intids(result_set):
+    if isinstance(result_set, SpillingIntIdSet):
+        # Stream it rather than building a BTrees set
+        return result_set
+    return _to_intids(result_set)
+
+
+@interface.implementer(IIntIdSet)
+class SpillingIntIdSet(object):
+    """
+    An :class:`~nti.segments.interfaces.IIntIdSet` over a sorted iterable of
+    unique intids (such as a :mod:`BTrees` set), stored in memory up to
+    ``budget`` bytes and in a memory mapped temporary file beyond that.
+    """
+
+    def __init__(self, intids=(), budget=DEFAULT_BUDGET, tempdir=None,
+                 family=BTrees.family64):
+        self.budget = budget
+        self.tempdir = tempdir
+        self.family = family
+        writer = _Writer(budget, tempdir)
+        writer.extend(intids)
+        self._values, self._file, self._mapped = writer.close()
+
+    @property
+    def spilled(self):
+        return self._mapped is not None
+
+    def __len__(self):
+        if self._mapped is None:
+            return len(self._values)
+        return len(self._mapped) // _ITEMSIZE
+
+    def __iter__(self):
+        if self._mapped is None:
+            return iter(self._values)
+        return self._iter_mapped()
+
+    def _iter_mapped(self):
+        mapped = self._mapped
+        step = _CHUNK_SIZE * _ITEMSIZE
+        for offset in range(0, len(mapped), step):
+            chunk = array(_TYPECODE)
+            _frombytes(chunk, mapped[offset:offset + step])
+            for intid in chunk:
+                yield intid
+
+    def close(self):
+        """
+        Release the memory and any file backing this set.
+        """
+        self._values = array(_TYPECODE)
+        if self._mapped is not None:
+            self._mapped.close()
+            self._file.close()
+            self._mapped = self._file = None
+
+    def intids(self):
+        # Callers wanting a BTrees set get one, at the cost of the bound
+        return self.family.IF.Set(self)
+
+    def _merged(self, result_set, left_only, both, right_only):
+        other = _sorted_intids(result_set)
+        return SpillingIntIdSet(_merge(self, other, left_only, both, right_only),
+                                self.budget, self.tempdir, self.family)
+
+    def intersection(self, result_set):
+        return self._merged(result_set, False, True, False)
+
+    def union(self, result_set):
+        return self._merged(result_set, True, True, True)
+
+    def difference(self, result_set):
+        return self._merged(result_set, True, False, False)
+
+
+def evaluate_bounded(filter_set, initial_set, budget=DEFAULT_BUDGET, tempdir=None):
+    """
+    Apply the filter set to the initial set, keeping each intermediate
+    result that is derived from the initial set within ``budget`` bytes of
+    memory.
+
+    :return: A :class:`SpillingIntIdSet`, or whatever the filter set's
+        leaves return when they don't derive their results from the initial
+        set.
+    """
+    initial = SpillingIntIdSet(_sorted_intids(initial_set), budget, tempdir)
+    return filter_set.apply(initial)
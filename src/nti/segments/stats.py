@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Rolling evaluation statistics of segments, for finding costly segments and
+for planning evaluations from real cardinalities.
+
+.. $Id$
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import math
+import time
+
+from BTrees.OOBTree import OOBTree
+
+from persistent import Persistent
+
+from zope import component
+from zope import interface
+
+from zope.annotation import factory as an_factory
+
+from zope.annotation.interfaces import IAnnotations
+
+from zope.container.contained import Contained
+
+from ZODB.utils import u64
+
+from nti.segments.evaluation import EvaluationContext
+from nti.segments.evaluation import cached_result
+from nti.segments.evaluation import evaluation
+
+from nti.segments.interfaces import ISegmentEvaluationStatistics
+from nti.segments.interfaces import ISegmentStatisticsStorage
+from nti.segments.interfaces import ISegmentsContainer
+
+logger = __import__('logging').getLogger(__name__)
+
+STATISTICS_ANNOTATION_KEY = 'nti.segments.stats.SegmentStatisticsStorage'
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+@interface.implementer(ISegmentEvaluationStatistics)
+class SegmentEvaluationStatistics(Persistent):
+
+    #: How many recent durations the percentile is computed over
+    window = 100
+
+    evaluations = 0
+    last_size = None
+    last_duration = None
+    generation = None
+    lastModified = 0
+
+    def __init__(self):
+        self.node_cardinalities = {}
+        self.durations = ()
+
+    @property
+    def p95_duration(self):
+        if not self.durations:
+            return None
+        durations = sorted(self.durations)
+        return durations[int(math.ceil(0.95 * len(durations))) - 1]
+
+    def record(self, size, node_cardinalities, duration, generation=None):
+        # Values are replaced rather than mutated so only this one object
+        # is written per evaluation.
+        self.evaluations += 1
+        self.last_size = size
+        self.node_cardinalities = dict(node_cardinalities)
+        self.last_duration = duration
+        self.durations = (self.durations + (duration,))[-self.window:]
+        self.generation = generation
+        self.lastModified = time.time()
+
+    def _p_resolveConflict(self, old, committed, new):
+        # Concurrent evaluations of the same segment: keep every duration
+        # and count, and the latest evaluation's details.
+        added = new.get('evaluations', 0) - old.get('evaluations', 0)
+        if new.get('lastModified', 0) >= committed.get('lastModified', 0):
+            result = dict(new)
+        else:
+            result = dict(committed)
+        result['evaluations'] = committed.get('evaluations', 0) + added
+        durations = committed.get('durations', ())
+        if added > 0:
+            durations += new.get('durations', ())[-added:]
+        result['durations'] = durations[-self.window:]
+        result['lastModified'] = max(committed.get('lastModified', 0),
+                                     new.get('lastModified', 0))
+        return result
+
+
+@component.adapter(ISegmentsContainer)
+@interface.implementer(ISegmentStatisticsStorage)
+class SegmentStatisticsStorage(Persistent, Contained):
+
+    def __init__(self):
+        self._statistics = OOBTree()
+
+    def get(self, segment_id, default=None):
+        return self._statistics.get(segment_id, default)
+
+    def statistics_for(self, segment_id):
+        result = self._statistics.get(segment_id)
+        if result is None:
+            result = self._statistics[segment_id] = SegmentEvaluationStatistics()
+        return result
+
+    def remove(self, segment_id):
+        self._statistics.pop(segment_id, None)
+
+    def items(self):
+        return self._statistics.items()
+
+
+_SegmentStatisticsStorageFactory = an_factory(SegmentStatisticsStorage,
+                                              STATISTICS_ANNOTATION_KEY)
+
+
+def get_statistics_storage(container, create=True):
+    """
+    Return the :class:`~nti.segments.interfaces.ISegmentStatisticsStorage`
+    of the container, or ``None`` if it has none and ``create`` is false.
+    """
+    if not create:
+        return IAnnotations(container).get(STATISTICS_ANNOTATION_KEY)
+    return ISegmentStatisticsStorage(container)
+
+
+def _children(filter_set):
+    children = getattr(filter_set, 'filter_sets', None)
+    if children is not None:
+        return list(children)
+    return [child for child in (getattr(filter_set, 'filter_set', None),
+                                getattr(filter_set, 'excluded_filter_set', None))
+            if child is not None]
+
+
+def _node_paths(filter_set, path=''):
+    yield path, filter_set
+    for index, child in enumerate(_children(filter_set)):
+        child_path = '%s.%s' % (path, index) if path else str(index)
+        for item in _node_paths(child, child_path):
+            yield item
+
+
+def _current_generation(segment):
+    # The transaction the connection's snapshot was taken at is the
+    # generation of everything it reads, the indexes included. Later
+    # commits to the database are not seen until the next transaction.
+    jar = getattr(segment, '_p_jar', None)
+    if jar is None:
+        return None
+    # Connections read the state current before ``before`` (historical
+    # connections) or before their storage instance's ``_start``.
+    before = getattr(jar, 'before', None)
+    if before is None:
+        before = getattr(getattr(jar, '_storage', None), '_start', None)
+    if before is None:
+        return None
+    return u64(before) - 1
+
+
+def evaluate_with_statistics(segment, initial_set, generation=None):
+    """
+    Evaluate the segment's filter set against the initial set, recording
+    statistics about the evaluation for the segment in its container.
+
+    The recorded node cardinalities are the sizes of the results of each
+    node as evaluated; the intersected children after the first are given
+    only the members selected so far, so theirs are conditional on the
+    children before them.
+
+    :keyword generation: The index generation evaluated at; by default the
+        transaction the segment's connection reads as of, if it is stored
+        in a database.
+    :return: The :class:`~nti.segments.interfaces.IIntIdSet` result.
+    """
+    if generation is None:
+        generation = _current_generation(segment)
+    context = EvaluationContext(record_cardinalities=True)
+    start = _clock()
+    with evaluation(context):
+        result = cached_result(segment.filter_set, initial_set)
+    duration = _clock() - start
+
+    cardinalities = context.cardinalities
+    node_cardinalities = dict((path, cardinalities[id(node)])
+                              for path, node in _node_paths(segment.filter_set)
+                              if id(node) in cardinalities)
+    container = getattr(segment, '__parent__', None)
+    if ISegmentsContainer.providedBy(container):
+        statistics = get_statistics_storage(container).statistics_for(segment.id)
+        statistics.record(node_cardinalities.get(''), node_cardinalities,
+                          duration, generation)
+    return result
+
+
+def costliest_segments(container, count=10):
+    """
+    Return the ``(segment_id, statistics)`` of the (at most) ``count``
+    segments of the container with the highest 95th percentile evaluation
+    times, highest first.
+    """
+    storage = get_statistics_storage(container, create=False)
+    if storage is None:
+        return []
+    measured = [(segment_id, statistics) for segment_id, statistics in storage.items()
+                if statistics.p95_duration is not None]
+    measured.sort(key=lambda item: item[1].p95_duration, reverse=True)
+    return measured[:count]
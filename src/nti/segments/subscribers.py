@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+.. $Id$
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import weakref
+
+import six
+
+import transaction
+
+from zope import component
+
+from zope.component.hooks import getSite
+from zope.component.hooks import site as current_site
+
+from zope.event import notify
+
+from zope.intid.interfaces import IIntIds
+
+from zope.lifecycleevent.interfaces import IObjectModifiedEvent
+from zope.lifecycleevent.interfaces import IObjectRemovedEvent
+
+from nti.coremetadata.interfaces import IX_TOPICS
+
+from nti.dataserver.interfaces import IEntity
+
+from nti.dataserver.users import get_entity_catalog
+
+from nti.segments.interfaces import IIndexesModifiedEvent
+from nti.segments.interfaces import ISegment
+from nti.segments.interfaces import ISegmentsContainer
+from nti.segments.interfaces import ISegmentsImportedEvent
+from nti.segments.interfaces import IndexesModifiedEvent
+
+from nti.segments.stats import get_statistics_storage
+
+from nti.site.hostpolicy import get_all_host_sites
+
+logger = __import__('logging').getLogger(__name__)
+
+
+#: Stands for index contents that can't be read
+_UNKNOWN = object()
+
+#: The entities modified in each transaction, by intid, with what the
+#: entity catalog held for them beforehand and the site they were
+#: modified in
+_modified_entities = weakref.WeakKeyDictionary()
+
+
+def _snapshot(value):
+    # Index values may be sets changed in place by reindexing
+    if value is None or isinstance(value, six.string_types) \
+            or not hasattr(value, '__iter__'):
+        return value
+    return tuple(value)
+
+
+def _indexed_state(catalog, intid):
+    # What the catalog holds for the intid, by index name; topic filters
+    # are included by their own names, as filter sets depend on them
+    result = {}
+    for name, index in catalog.items():
+        values = getattr(index, 'documents_to_values', None)
+        if values is None:
+            values = getattr(index, '_rev_index', None)
+        result[name] = _UNKNOWN if values is None else _snapshot(values.get(intid))
+    topics = catalog.get(IX_TOPICS)
+    filters = getattr(topics, '_filters', None)
+    if filters is not None:
+        for name, extent in filters.items():
+            result[name] = intid in extent.getIds()
+        result[IX_TOPICS] = tuple(sorted((name, result[name]) for name in filters))
+    return result
+
+
+def _changed_index_names(before, after):
+    result = set()
+    for name in set(before).union(after):
+        old = before.get(name, _UNKNOWN)
+        new = after.get(name, _UNKNOWN)
+        if old is _UNKNOWN or new is _UNKNOWN or old != new:
+            result.add(name)
+    return result
+
+
+def _entities_reindexed(catalog, modified):
+    # Run before commit, once every modification has been reindexed
+    changes = {}
+    for intid, (before, site) in modified.items():
+        names = _changed_index_names(before, _indexed_state(catalog, intid))
+        if names:
+            changes.setdefault(id(site), (site, set()))[1].update(names)
+    for site, names in changes.values():
+        with current_site(site):
+            notify(IndexesModifiedEvent(names))
+
+
+@component.adapter(IEntity, IObjectModifiedEvent)
+def _on_entity_modified(entity, unused_event):
+    # The entity catalog reindexes the entity on modification, after this
+    # (object event subscribers come first); only the indexes whose
+    # contents for it change by the end of the transaction are reported.
+    catalog = get_entity_catalog()
+    intids = component.queryUtility(IIntIds)
+    intid = intids.queryId(entity) if intids is not None else None
+    if catalog is None or intid is None:
+        return
+    current = transaction.get()
+    modified = _modified_entities.get(current)
+    if modified is None:
+        modified = _modified_entities[current] = {}
+        current.addBeforeCommitHook(_entities_reindexed, (catalog, modified))
+    if intid not in modified:
+        modified[intid] = (_indexed_state(catalog, intid), getSite())
+
+
+def _segments_containers():
+    result = {}
+    if getSite() is not None:
+        # Those whose populations can include entities of the current
+        # site: its own and those it inherits
+        sites = [None]
+    else:
+        # Without a site, any may be affected
+        sites = [None] + list(get_all_host_sites())
+    for context in sites:
+        for container in component.getAllUtilitiesRegisteredFor(ISegmentsContainer,
+                                                                context=context):
+            result[id(container)] = container
+    return result.values()
+
+
+@component.adapter(IIndexesModifiedEvent)
+def _on_indexes_modified(event):
+    for container in _segments_containers():
+        dirtied = container.mark_dirty(event.names)
+        if dirtied:
+            logger.debug("Marked %s segment(s) dirty after changes to %s",
+                         len(dirtied), sorted(event.names))
+
+
+@component.adapter(ISegment, IObjectModifiedEvent)
+def _on_segment_modified(segment, unused_event):
+    container = getattr(segment, '__parent__', None)
+    if ISegmentsContainer.providedBy(container):
+        container.update_filter_set(segment)
+
+
+@component.adapter(ISegment, IObjectRemovedEvent)
+def _on_segment_removed(segment, event):
+    if not ISegmentsContainer.providedBy(event.oldParent):
+        return
+    storage = get_statistics_storage(event.oldParent, create=False)
+    if storage is not None:
+        storage.remove(event.oldName)
+
+
+@component.adapter(ISegmentsImportedEvent)
+def _on_segments_imported(event):
+    # Stands in for the intid registration of each segment's added event
+    utilities = component.getAllUtilitiesRegisteredFor(IIntIds,
+                                                       context=event.object)
+    for utility in utilities:
+        for segment in event.segments:
+            utility.register(segment)
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Segment templates: filter set trees with parameterized leaves, bound to
+different arguments to define many segments of the same shape.
+
+A template is analyzed once. Subtrees without parameters are shared, as
+the same objects, by every binding. When the root is an intersection its
+unparameterized children are evaluated once for all bindings, and only
+the parameterized ones are evaluated per binding, against that prefix.
+The bound trees are cached in least recently used order; results are
+only kept for one evaluation, as the indexes may change between them.
+
+.. $Id$
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from collections import OrderedDict
+
+from zope import interface
+
+from nti.segments.canonical import hashable
+
+from nti.segments.evaluation import EvaluationContext
+from nti.segments.evaluation import cached_result
+from nti.segments.evaluation import evaluation
+
+from nti.segments.interfaces import IDifferenceUserFilterSet
+from nti.segments.interfaces import IIntersectionUserFilterSet
+from nti.segments.interfaces import INotUserFilterSet
+from nti.segments.interfaces import IUnionUserFilterSet
+from nti.segments.interfaces import IUserFilterSet
+
+from nti.segments.model import IntersectionUserFilterSet
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The default number of bindings whose trees are kept
+DEFAULT_MAX_BINDINGS = 1000
+
+
+class Parameter(object):
+    """
+    A placeholder for a leaf argument, substituted when a template is bound.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __eq__(self, other):
+        return isinstance(other, Parameter) and other.name == self.name
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((Parameter, self.name))
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self.name)
+
+
+@interface.implementer(IUserFilterSet)
+class ParameterizedFilterSet(object):
+    """
+    A leaf of a template, created by calling ``factory`` with the
+    ``arguments``, any :class:`Parameter` values of which are replaced by
+    the bound values.
+    """
+
+    def __init__(self, factory, **arguments):
+        self.factory = factory
+        self.arguments = arguments
+
+    @property
+    def parameters(self):
+        return frozenset(value.name for value in self.arguments.values()
+                         if isinstance(value, Parameter))
+
+    @property
+    def dependencies(self):
+        result = getattr(self.factory, 'dependencies', None)
+        return result if isinstance(result, frozenset) else None
+
+    def bind(self, arguments):
+        resolved = dict((name, arguments[value.name] if isinstance(value, Parameter) else value)
+                        for name, value in self.arguments.items())
+        return self.factory(**resolved)
+
+    def apply(self, initial_set):
+        raise ValueError("Unbound parameters %s" % ', '.join(sorted(self.parameters)))
+
+
+def _children(filter_set):
+    if IUnionUserFilterSet.providedBy(filter_set) \
+            or IIntersectionUserFilterSet.providedBy(filter_set):
+        return tuple(filter_set.filter_sets)
+    if INotUserFilterSet.providedBy(filter_set):
+        return (filter_set.filter_set,)
+    if IDifferenceUserFilterSet.providedBy(filter_set):
+        return (filter_set.filter_set, filter_set.excluded_filter_set)
+    return ()
+
+
+def _parameters(filter_set, nodes):
+    # Collects the ids of the parameterized nodes into ``nodes``
+    if isinstance(filter_set, ParameterizedFilterSet):
+        result = filter_set.parameters
+    else:
+        result = frozenset()
+        for child in _children(filter_set):
+            result = result.union(_parameters(child, nodes))
+    if result:
+        nodes.add(id(filter_set))
+    return result
+
+
+def _lru_get(cache, key):
+    try:
+        value = cache.pop(key)
+    except KeyError:
+        return None
+    # Now the most recently used
+    cache[key] = value
+    return value
+
+
+def _lru_set(cache, key, value, size):
+    cache[key] = value
+    while len(cache) > size:
+        cache.popitem(last=False)
+    return value
+
+
+class SegmentTemplate(object):
+    """
+    A template for segments whose filter set trees differ only in the
+    arguments of some leaves, given as :class:`ParameterizedFilterSet`
+    objects within ``filter_set``.
+
+    The trees of the ``max_bindings`` most recently used bindings are
+    kept.
+    """
+
+    def __init__(self, filter_set, max_bindings=DEFAULT_MAX_BINDINGS):
+        self.filter_set = filter_set
+        self.max_bindings = max_bindings
+        self._nodes = set()
+        self.parameters = _parameters(filter_set, self._nodes)
+        self._bound = OrderedDict()
+        # The unparameterized intersected children form a prefix shared by
+        # every binding; the rest are bound and applied to its result.
+        self._prefix = None
+        self._parameterized = None
+        if IIntersectionUserFilterSet.providedBy(filter_set):
+            children = tuple(filter_set.filter_sets)
+            parameterized = tuple(x for x in children if id(x) in self._nodes)
+            if parameterized and len(parameterized) < len(children):
+                self._prefix = IntersectionUserFilterSet(
+                    filter_sets=tuple(x for x in children if id(x) not in self._nodes))
+                self._parameterized = parameterized
+
+    def _bind(self, filter_set, arguments):
+        if isinstance(filter_set, ParameterizedFilterSet):
+            return filter_set.bind(arguments)
+        if id(filter_set) not in self._nodes:
+            # Shared, so its results can be too
+            return filter_set
+        if IUnionUserFilterSet.providedBy(filter_set) \
+                or IIntersectionUserFilterSet.providedBy(filter_set):
+            return type(filter_set)(filter_sets=tuple(self._bind(x, arguments)
+                                                      for x in filter_set.filter_sets))
+        if INotUserFilterSet.providedBy(filter_set):
+            return type(filter_set)(filter_set=self._bind(filter_set.filter_set, arguments))
+        return type(filter_set)(
+            filter_set=self._bind(filter_set.filter_set, arguments),
+            excluded_filter_set=self._bind(filter_set.excluded_filter_set, arguments))
+
+    def _key(self, arguments):
+        missing = self.parameters.difference(arguments)
+        if missing:
+            raise KeyError("Missing parameters %s" % ', '.join(sorted(missing)))
+        return tuple(sorted((name, hashable(arguments[name])) for name in self.parameters))
+
+    def bind(self, **arguments):
+        """
+        Return the filter set tree for the arguments, which must give a
+        value for each parameter. Trees are cached per binding.
+        """
+        key = self._key(arguments)
+        result = _lru_get(self._bound, key)
+        if result is None:
+            result = _lru_set(self._bound, key, self._bind(self.filter_set, arguments),
+                              self.max_bindings)
+        return result
+
+    def _bound_remainder(self, key, arguments):
+        key = ('remainder',) + key
+        result = _lru_get(self._bound, key)
+        if result is None:
+            result = _lru_set(self._bound, key, IntersectionUserFilterSet(
+                filter_sets=tuple(self._bind(x, arguments) for x in self._parameterized)),
+                self.max_bindings)
+        return result
+
+    def _evaluate(self, key, arguments, initial_set):
+        if self._prefix is None:
+            return cached_result(self.bind(**arguments), initial_set)
+        # Shared by the bindings through the evaluation context
+        prefix = cached_result(self._prefix, initial_set)
+        remainder = self._bound_remainder(key, arguments)
+        return prefix.intersection(cached_result(remainder, prefix))
+
+    def evaluate(self, bindings, initial_set):
+        """
+        Evaluate the template for each of the bindings (mappings of
+        parameter names to values) against the same initial set, evaluating
+        what they have in common once.
+
+        Results are reused for repeated bindings within the call, but not
+        kept between calls, as the indexes they were computed from may have
+        changed since.
+
+        :return: A list of :class:`~nti.segments.interfaces.IIntIdSet`, in
+            the order of the bindings.
+        """
+        result = []
+        results = {}
+        with evaluation(EvaluationContext(share_results=True)):
+            for arguments in bindings:
+                key = self._key(arguments)
+                value = results.get(key)
+                if value is None:
+                    value = results[key] = self._evaluate(key, arguments, initial_set)
+                result.append(value)
+        return result
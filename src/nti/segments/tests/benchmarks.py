@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks of the intid set algebra and the combinator filter sets,
+over a matrix of set sizes, densities and skews in both 64 and 32 bit
+:mod:`BTrees` families.
+
+Run as a script to print the timings, optionally saving them as a JSON
+baseline or comparing them against one::
+
+    python -m nti.segments.tests.benchmarks --save baseline.json
+    python -m nti.segments.tests.benchmarks --compare baseline.json
+
+When comparing, benchmarks slower than the baseline by more than the
+threshold are reported and the exit status is non-zero.
+
+.. $Id$
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import random
+import sys
+import timeit
+
+import BTrees
+
+from zope import interface
+
+from nti.segments.interfaces import IUserFilterSet
+
+from nti.segments.model import DifferenceUserFilterSet
+from nti.segments.model import IntIdSet
+from nti.segments.model import IntersectionUserFilterSet
+from nti.segments.model import NotUserFilterSet
+from nti.segments.model import UnionUserFilterSet
+from nti.segments.model import _to_intids
+
+#: Sizes of the larger operand
+SIZES = (1000, 10000, 100000)
+
+#: Fraction of the intid range the members are drawn from that they fill
+DENSITIES = (0.01, 0.5)
+
+#: Ratio of the larger to the smaller operand
+SKEWS = (1, 100)
+
+FAMILIES = (('family64', BTrees.family64), ('family32', BTrees.family32))
+
+#: Default fraction a benchmark may slow down by before being reported
+DEFAULT_THRESHOLD = 0.2
+
+
+@interface.implementer(IUserFilterSet)
+class _StaticFilterSet(object):
+
+    def __init__(self, intids, family):
+        self.intids = intids
+        self.family = family
+
+    def apply(self, initial_set):
+        return IntIdSet(self.family.IF.intersection(self.intids,
+                                                    _to_intids(initial_set)),
+                        self.family)
+
+
+def _intids(rng, family, size, density):
+    universe = int(size / density)
+    return family.IF.Set(rng.sample(range(universe), size))
+
+
+def _cases(family, first, second, population):
+    first_set = IntIdSet(first, family)
+    first_leaf = _StaticFilterSet(first, family)
+    second_leaf = _StaticFilterSet(second, family)
+    union = UnionUserFilterSet(filter_sets=(first_leaf, second_leaf))
+    intersection = IntersectionUserFilterSet(filter_sets=(
+        UnionUserFilterSet(filter_sets=(first_leaf,)),
+        UnionUserFilterSet(filter_sets=(second_leaf,))))
+    negation = NotUserFilterSet(filter_set=second_leaf)
+    difference = DifferenceUserFilterSet(filter_set=first_leaf,
+                                         excluded_filter_set=second_leaf)
+    return (
+        ('IntIdSet.union', lambda: first_set.union(second)),
+        ('IntIdSet.intersection', lambda: first_set.intersection(second)),
+        ('IntIdSet.difference', lambda: first_set.difference(second)),
+        ('_to_intids', lambda: _to_intids(first_set)),
+        ('UnionUserFilterSet.apply', lambda: union.apply(population)),
+        ('IntersectionUserFilterSet.apply', lambda: intersection.apply(population)),
+        ('NotUserFilterSet.apply', lambda: negation.apply(population)),
+        ('DifferenceUserFilterSet.apply', lambda: difference.apply(population)),
+    )
+
+
+def run(repeat=5, seed=42, sizes=SIZES):
+    """
+    Run the benchmarks, returning a mapping of their names to the best
+    time in seconds of a single call.
+    """
+    result = {}
+    rng = random.Random(seed)
+    for family_name, family in FAMILIES:
+        for size in sizes:
+            for density in DENSITIES:
+                for skew in SKEWS:
+                    first = _intids(rng, family, size, density)
+                    second = _intids(rng, family, max(size // skew, 1), density)
+                    population = IntIdSet(family.IF.union(first, second), family)
+                    # Fewer calls for the bigger sets, about the same total time
+                    number = max(100000 // size, 1)
+                    for name, func in _cases(family, first, second, population):
+                        key = '%s %s size=%s density=%s skew=%s' % (
+                            name, family_name, size, density, skew)
+                        times = timeit.Timer(func).repeat(repeat, number)
+                        result[key] = min(times) / number
+    return result
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Return ``(name, baseline, result)`` for the benchmarks slower than the
+    baseline by more than ``threshold``.
+    """
+    regressions = []
+    for name in sorted(results):
+        expected = baseline.get(name)
+        if expected and results[name] > expected * (1 + threshold):
+            regressions.append((name, expected, results[name]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--save', help="Write the results to this JSON file")
+    parser.add_argument('--compare', help="Compare with the results in this JSON file")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="Fraction slower than the baseline to report")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--quick', action='store_true',
+                        help="Only benchmark the smallest sets")
+    args = parser.parse_args(argv)
+
+    results = run(args.repeat, sizes=SIZES[:1] if args.quick else SIZES)
+    for name in sorted(results):
+        print('%-80s %12.3fus' % (name, results[name] * 1e6))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for name, expected, actual in regressions:
+            print('SLOWER %-73s %12.3fus -> %.3fus (%+.0f%%)' % (
+                name, expected * 1e6, actual * 1e6, (actual / expected - 1) * 100))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main())
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+
+from unittest import TestCase
+from unittest import skipIf
+
+import BTrees
+
+from hamcrest import assert_that
+from hamcrest import calling
+from hamcrest import contains
+from hamcrest import is_
+from hamcrest import raises
+
+try:
+    import asyncio
+except ImportError:  # pragma: no cover
+    asyncio = None
+else:
+    from nti.segments.aio import AsyncSegmentEvaluator
+
+from nti.segments.model import IntIdSet
+from nti.segments.model import IntersectionUserFilterSet
+from nti.segments.model import UnionUserFilterSet
+from nti.segments.model import UserSegment
+
+from nti.segments.tests import SharedConfiguringTestLayer
+
+from nti.segments.tests.test_model import TestFilterSet
+
+
+class BlockingFilterSet(TestFilterSet):
+
+    def __init__(self, ids=None):
+        TestFilterSet.__init__(self, ids)
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.applied = False
+
+    def apply(self, initial_set):
+        self.started.set()
+        self.release.wait(5)
+        self.applied = True
+        return TestFilterSet.apply(self, initial_set)
+
+
+@skipIf(asyncio is None, "Requires asyncio")
+class TestAsyncSegmentEvaluator(TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.evaluator = AsyncSegmentEvaluator(max_concurrency=2)
+        self.initial = IntIdSet(BTrees.family64.IF.Set(range(10)))
+
+    def tearDown(self):
+        self.evaluator.close()
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def test_evaluate_segments(self):
+        segments = [
+            UserSegment(title=u'First', filter_set=IntersectionUserFilterSet(
+                filter_sets=(UnionUserFilterSet(filter_sets=(TestFilterSet([1, 2]),)),))),
+            UserSegment(title=u'Second', filter_set=IntersectionUserFilterSet(
+                filter_sets=(UnionUserFilterSet(filter_sets=(TestFilterSet([3]),)),))),
+        ]
+        results = self.loop.run_until_complete(
+            self.evaluator.evaluate_segments(segments, self.initial))
+        assert_that([list(result.intids()) for result in results],
+                    contains([1, 2], [3]))
+
+    def test_timeout(self):
+        blocking = BlockingFilterSet([1])
+        never_reached = BlockingFilterSet([2])
+        never_reached.release.set()
+        filter_set = UnionUserFilterSet(filter_sets=(blocking, never_reached))
+
+        evaluating = self.evaluator.evaluate(filter_set, self.initial, timeout=0.05)
+        assert_that(calling(self.loop.run_until_complete).with_args(evaluating),
+                    raises(asyncio.TimeoutError))
+
+        blocking.release.set()
+        self.evaluator.executor.shutdown(wait=True)
+        assert_that(blocking.applied, is_(True))
+        # Stopped at the checkpoint before the next child
+        assert_that(never_reached.applied, is_(False))
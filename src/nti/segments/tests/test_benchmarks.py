@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from unittest import TestCase
+
+from hamcrest import assert_that
+from hamcrest import contains
+from hamcrest import has_length
+from hamcrest import is_
+
+from nti.segments.tests import SharedConfiguringTestLayer
+
+from nti.segments.tests.benchmarks import compare
+from nti.segments.tests.benchmarks import run
+
+
+class TestBenchmarks(TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def test_run(self):
+        results = run(repeat=1, sizes=(1000,))
+        # 8 benchmarks for each family, density and skew
+        assert_that(results, has_length(32))
+
+    def test_compare(self):
+        baseline = {'fast': 1.0, 'slow': 1.0, 'new': None}
+        regressions = compare({'fast': 1.1, 'slow': 1.5, 'new': 1.0, 'added': 1.0},
+                              baseline, threshold=0.2)
+        assert_that(regressions, contains(contains('slow', 1.0, 1.5)))
+        assert_that(compare({'slow': 1.5}, baseline, threshold=1), is_([]))
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from io import StringIO
+
+from unittest import TestCase
+
+import six
+
+from hamcrest import assert_that
+from hamcrest import contains
+from hamcrest import contains_inanyorder
+from hamcrest import has_length
+from hamcrest import has_properties
+from hamcrest import is_
+
+from zope import component
+
+from zope.intid.interfaces import IIntIds
+
+from zope.lifecycleevent.interfaces import IObjectAddedEvent
+
+from nti.segments.bulk import export_segments
+from nti.segments.bulk import import_segments
+
+from nti.segments.interfaces import ISegmentsImportedEvent
+
+from nti.segments.model import SegmentsContainer
+from nti.segments.model import UserSegment
+
+from nti.segments.tests import SharedConfiguringTestLayer
+
+
+class _IntIds(object):
+
+    def __init__(self):
+        self.registered = []
+
+    def register(self, ob):
+        self.registered.append(ob)
+
+
+class TestBulk(TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def test_round_trip(self):
+        source = SegmentsContainer()
+        for title in (u'One', u'Two', u'Three'):
+            source.add(UserSegment(title=title))
+        stream = StringIO()
+        assert_that(export_segments(source.values(), stream), is_(3))
+        assert_that(stream.getvalue().splitlines(), has_length(3))
+
+        events = []
+        gsm = component.getGlobalSiteManager()
+        gsm.registerHandler(events.append, (IObjectAddedEvent,))
+        gsm.registerHandler(events.append, (ISegmentsImportedEvent,))
+        intids = _IntIds()
+        gsm.registerUtility(intids, IIntIds)
+        chunks = []
+        target = SegmentsContainer()
+        target.add(UserSegment(title=u'Existing'))
+        del events[:]
+        try:
+            stream.seek(0)
+            imported = import_segments(target, stream, chunk_size=2,
+                                       on_chunk=chunks.append)
+        finally:
+            gsm.unregisterHandler(events.append, (IObjectAddedEvent,))
+            gsm.unregisterHandler(events.append, (ISegmentsImportedEvent,))
+            gsm.unregisterUtility(intids, IIntIds)
+
+        assert_that(imported, has_length(3))
+        assert_that(target, has_length(4))
+        assert_that([segment.title for segment in imported],
+                    contains_inanyorder(u'One', u'Two', u'Three'))
+        for segment in imported:
+            assert_that(target[segment.id], is_(segment))
+            assert_that(segment, has_properties(__parent__=target,
+                                                __name__=segment.id))
+        assert_that([len(chunk) for chunk in chunks], contains(2, 1))
+
+        # An event per chunk rather than per segment
+        assert_that(events, has_length(2))
+        assert_that([event.segments for event in events], contains(*chunks))
+        for event in events:
+            assert_that(event, has_properties(object=target))
+
+        # The subscriber gave each segment an intid
+        assert_that(intids.registered, contains(*imported))
+
+    def test_export_text(self):
+        container = SegmentsContainer()
+        container.add(UserSegment(title=u'One'))
+        stream = StringIO()
+        export_segments(container.values(), stream)
+        assert_that(stream.getvalue(), is_(six.text_type))
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from unittest import TestCase
+
+import BTrees
+
+import transaction
+
+from hamcrest import assert_that
+from hamcrest import contains
+from hamcrest import has_length
+from hamcrest import has_properties
+from hamcrest import is_
+from hamcrest import is_not
+from hamcrest import none
+from hamcrest import same_instance
+
+from zope.event import notify
+
+from zope.lifecycleevent import ObjectModifiedEvent
+
+from ZODB import DB
+
+from ZODB.MappingStorage import MappingStorage
+
+from nti.segments.canonical import canonical_key
+from nti.segments.canonical import canonicalize
+
+from nti.segments.evaluation import evaluate_segments
+
+from nti.segments.model import IntIdSet
+from nti.segments.model import IntersectionUserFilterSet
+from nti.segments.model import IsDeactivatedFilterSet
+from nti.segments.model import NotUserFilterSet
+from nti.segments.model import SegmentsContainer
+from nti.segments.model import UnionUserFilterSet
+from nti.segments.model import UserSegment
+
+from nti.segments.tests import SharedConfiguringTestLayer
+
+from nti.segments.tests.test_model import TestFilterSet
+
+
+class CountingFilterSet(TestFilterSet):
+
+    applied = 0
+
+    def apply(self, initial_set):
+        CountingFilterSet.applied += 1
+        return TestFilterSet.apply(self, initial_set)
+
+
+class StatefulFilterSet(TestFilterSet):
+
+    def __init__(self, ids=None, source=None):
+        TestFilterSet.__init__(self, ids)
+        self.source = source
+
+
+def _union(*ids):
+    return UnionUserFilterSet(filter_sets=tuple(TestFilterSet(x) for x in ids))
+
+
+class TestCanonical(TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def test_canonicalize(self):
+        filter_set = IntersectionUserFilterSet(filter_sets=(
+            _union([3], [1, 2], [3]),
+            NotUserFilterSet(filter_set=TestFilterSet([4])),
+            _union([1, 2], [3]),
+        ))
+        other = IntersectionUserFilterSet(filter_sets=(
+            NotUserFilterSet(filter_set=TestFilterSet([4])),
+            _union([1, 2], [3]),
+        ))
+        assert_that(canonical_key(filter_set), is_(canonical_key(other)))
+        assert_that(canonical_key(filter_set),
+                    is_not(canonical_key(_union([1, 2], [3]))))
+
+        canonical = canonicalize(filter_set)
+        assert_that(canonical_key(canonical), is_(canonical_key(filter_set)))
+        # Deduplicated, keeping the order of the children
+        assert_that(canonical.filter_sets, has_length(2))
+        assert_that(canonical.filter_sets[1], is_(NotUserFilterSet))
+        union = canonical.filter_sets[0]
+        assert_that([x.ids for x in union.filter_sets], contains((3,), (1, 2)))
+
+        initial = IntIdSet(BTrees.family64.IF.Set(range(10)))
+        assert_that(list(canonical.apply(initial).intids()),
+                    is_(list(filter_set.apply(initial).intids())))
+
+    def test_container_interning(self):
+        container = SegmentsContainer()
+        first = container.add(UserSegment(
+            title=u'First',
+            filter_set=IntersectionUserFilterSet(filter_sets=(_union([1], [2]),
+                                                              _union([3])))))
+        second = container.add(UserSegment(
+            title=u'Second',
+            filter_set=IntersectionUserFilterSet(filter_sets=(_union([3]),
+                                                              _union([2], [1])))))
+        third = container.add(UserSegment(
+            title=u'Third',
+            filter_set=IntersectionUserFilterSet(filter_sets=(_union([2], [1]),))))
+
+        assert_that(second.filter_set, is_(same_instance(first.filter_set)))
+        shared = [x for x in first.filter_set.filter_sets
+                  if x.filter_sets[0].ids == (1,)][0]
+        assert_that(third.filter_set.filter_sets[0], is_(same_instance(shared)))
+
+    def test_undeclared_state(self):
+        first = StatefulFilterSet([1], u'first')
+        second = StatefulFilterSet([1], u'second')
+        assert_that(canonical_key(first), is_(none()))
+        assert_that(canonical_key(UnionUserFilterSet(filter_sets=(first,))),
+                    is_(none()))
+
+        container = SegmentsContainer()
+        segments = [container.add(UserSegment(
+            title=u'Segment',
+            filter_set=IntersectionUserFilterSet(filter_sets=(
+                UnionUserFilterSet(filter_sets=(leaf,)),))))
+            for leaf in (first, second)]
+        assert_that(segments[0].filter_set.filter_sets[0].filter_sets[0],
+                    is_(same_instance(first)))
+        assert_that(segments[1].filter_set.filter_sets[0].filter_sets[0],
+                    is_(same_instance(second)))
+
+    def test_remove_releases(self):
+        container = SegmentsContainer()
+
+        def _segment():
+            return container.add(UserSegment(
+                title=u'Segment',
+                filter_set=IntersectionUserFilterSet(filter_sets=(_union([1], [2]),))))
+
+        first = _segment()
+        second = _segment()
+        entries = len(container._filter_sets)
+        assert_that(entries, is_(4))
+
+        container.remove(first)
+        assert_that(container._filter_sets, has_length(entries))
+        assert_that(second.filter_set.apply(IntIdSet(BTrees.family64.IF.Set(range(5)))),
+                    has_properties(intids=is_not(None)))
+        container.remove(second)
+        assert_that(container._filter_sets, has_length(0))
+        assert_that(container._filter_set_counts, has_length(0))
+
+    def test_replaced_filter_set(self):
+        container = SegmentsContainer()
+        segment = container.add(UserSegment(
+            title=u'Segment',
+            filter_set=IntersectionUserFilterSet(filter_sets=(_union([1], [2]),))))
+        other = container.add(UserSegment(
+            title=u'Other',
+            filter_set=IntersectionUserFilterSet(filter_sets=(_union([1]),))))
+        entries = len(container._filter_sets)
+
+        # Changes other than the filter set leave the table alone
+        segment.title = u'Renamed'
+        notify(ObjectModifiedEvent(segment))
+        assert_that(container._filter_sets, has_length(entries))
+
+        segment.filter_set = IntersectionUserFilterSet(filter_sets=(_union([1]),))
+        notify(ObjectModifiedEvent(segment))
+        assert_that(segment.filter_set, is_(same_instance(other.filter_set)))
+        # Only the entries of the other segment's tree are left
+        assert_that(container._filter_sets, has_length(3))
+        container.remove(segment)
+        container.remove(other)
+        assert_that(container._filter_sets, has_length(0))
+        assert_that(container._filter_set_counts, has_length(0))
+
+    def test_release_after_reload(self):
+        db = DB(MappingStorage())
+        try:
+            connection = db.open()
+            container = connection.root()['segments'] = SegmentsContainer()
+            for _ in range(2):
+                container.add(UserSegment(
+                    title=u'Segment',
+                    filter_set=IntersectionUserFilterSet(filter_sets=(UnionUserFilterSet(
+                        filter_sets=(IsDeactivatedFilterSet(Deactivated=True),
+                                     TestFilterSet([1]))),))))
+            transaction.commit()
+            connection.close()
+
+            # Leaves are loaded separately by the table and the trees
+            connection = db.open()
+            container = connection.root()['segments']
+            assert_that(container._filter_sets, has_length(4))
+            for segment in list(container.values()):
+                container.remove(segment)
+            assert_that(container._filter_sets, has_length(0))
+            assert_that(container._filter_set_counts, has_length(0))
+            transaction.abort()
+            connection.close()
+        finally:
+            db.close()
+
+    def test_evaluate_segments(self):
+        def _segment(title):
+            return UserSegment(title=title, filter_set=IntersectionUserFilterSet(
+                filter_sets=(UnionUserFilterSet(
+                    filter_sets=(CountingFilterSet([1, 2]),)),)))
+
+        container = SegmentsContainer()
+        first = container.add(_segment(u'First'))
+        second = container.add(_segment(u'Second'))
+
+        CountingFilterSet.applied = 0
+        initial = IntIdSet(BTrees.family64.IF.Set(range(10)))
+        results = evaluate_segments(container.values(), initial)
+        assert_that(CountingFilterSet.applied, is_(1))
+        assert_that(results[first.id].intids(), contains(1, 2))
+        assert_that(results[second.id], has_properties(intids=is_not(None)))
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+import BTrees
+
+import transaction
+
+from hamcrest import assert_that
+from hamcrest import calling
+from hamcrest import contains
+from hamcrest import contains_inanyorder
+from hamcrest import has_entries
+from hamcrest import has_length
+from hamcrest import has_properties
+from hamcrest import is_
+from hamcrest import raises
+
+from ZODB import DB
+
+from ZODB.FileStorage import FileStorage
+
+from ZODB.POSException import ConflictError
+
+from nti.segments.conflicts import resolve_state
+
+from nti.segments.model import IntersectionUserFilterSet
+from nti.segments.model import SegmentsContainer
+from nti.segments.model import UnionUserFilterSet
+from nti.segments.model import UserSegment
+
+from nti.segments.stats import SegmentEvaluationStatistics
+from nti.segments.stats import get_statistics_storage
+
+from nti.segments.tests import SharedConfiguringTestLayer
+
+from nti.segments.tests.test_model import TestFilterSet
+
+
+class TestResolveState(TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def test_disjoint_changes(self):
+        old = {'dirty': False, 'result': 1, 'title': u'a', 'lastModified': 1}
+        committed = dict(old, dirty=True, lastModified=3)
+        new = dict(old, result=2, lastModified=2)
+        assert_that(resolve_state(old, committed, new, timestamps=('lastModified',)),
+                    has_entries(dirty=True, result=2, title=u'a', lastModified=3))
+
+    def test_counters(self):
+        assert_that(resolve_state({'count': 1}, {'count': 3}, {'count': 2},
+                                  counters=('count',)),
+                    has_entries(count=4))
+
+    def test_conflict(self):
+        assert_that(calling(resolve_state).with_args({'title': u'a'},
+                                                     {'title': u'b'},
+                                                     {'title': u'c'}),
+                    raises(ConflictError))
+
+    def test_persistent_timestamps(self):
+        # Persistent maximums resolve their own conflicts, so only a
+        # replaced one is merged here
+        maximum, other = object(), object()
+        old = {'_lastModified': maximum, 'title': u'a'}
+        assert_that(resolve_state(old, dict(old, title=u'b'), dict(old),
+                                  timestamps=('_lastModified',)),
+                    has_entries(_lastModified=maximum, title=u'b'))
+        assert_that(resolve_state(old, dict(old), dict(old, _lastModified=other),
+                                  timestamps=('_lastModified',)),
+                    has_entries(_lastModified=other))
+
+    def test_segment(self):
+        segment = UserSegment(title=u'Segment')
+        old = {'title': u'a', 'dirty': False, 'lastModified': 1}
+        assert_that(segment._p_resolveConflict(old,
+                                               dict(old, title=u'b', lastModified=2),
+                                               dict(old, dirty=True, lastModified=3)),
+                    has_entries(title=u'b', dirty=True, lastModified=3))
+
+    def test_statistics(self):
+        statistics = SegmentEvaluationStatistics()
+        old = {'evaluations': 1, 'durations': (1,), 'last_size': 10,
+               'lastModified': 1}
+        committed = {'evaluations': 2, 'durations': (1, 2), 'last_size': 20,
+                     'lastModified': 2}
+        new = {'evaluations': 3, 'durations': (1, 3, 4), 'last_size': 30,
+               'lastModified': 3}
+        result = statistics._p_resolveConflict(old, committed, new)
+        assert_that(result, has_entries(evaluations=4, last_size=30,
+                                        lastModified=3))
+        assert_that(result['durations'], contains(1, 2, 3, 4))
+
+
+def _filter_set(*ids):
+    return IntersectionUserFilterSet(filter_sets=(
+        UnionUserFilterSet(filter_sets=(TestFilterSet(ids),)),))
+
+
+class TestConcurrentTransactions(TestCase):
+    """
+    Concurrent transactions committed through a real database, which calls
+    the resolvers only for the objects both actually changed. (Unlike
+    ``MappingStorage``, ``FileStorage`` resolves conflicts.)
+    """
+
+    layer = SharedConfiguringTestLayer
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = DB(FileStorage(os.path.join(self.directory, 'Data.fs')))
+        self.connections = []
+        first, root = self._open()
+        container = root['segments'] = SegmentsContainer()
+        segment = container.add(UserSegment(title=u'Segment',
+                                            filter_set=_filter_set(1)))
+        segment.publish_result(BTrees.family64.IF.Set())
+        get_statistics_storage(container).statistics_for(segment.id).record(
+            0, {'': 0}, 0.5)
+        first.commit()
+        self.segment_id = segment.id
+        # Both see the same starting state
+        self.first = first, root['segments']
+        second, root = self._open()
+        self.second = second, root['segments']
+
+    def tearDown(self):
+        for manager, connection in self.connections:
+            manager.abort()
+            connection.close()
+        self.db.close()
+        shutil.rmtree(self.directory)
+
+    def _open(self):
+        manager = transaction.TransactionManager()
+        connection = self.db.open(manager)
+        self.connections.append((manager, connection))
+        return manager, connection.root()
+
+    def _current(self):
+        return self._open()[1]['segments']
+
+    def test_publish_and_mark_dirty(self):
+        first, container = self.first
+        container[self.segment_id].publish_result(BTrees.family64.IF.Set([1]))
+        second, other = self.second
+        assert_that(other.mark_dirty(('unknown',)), has_length(1))
+        first.commit()
+        second.commit()
+
+        segment = self._current()[self.segment_id]
+        assert_that(segment.dirty, is_(True))
+        assert_that(list(segment.result.intids), contains(1))
+
+    def test_concurrent_adds(self):
+        first, container = self.first
+        added = container.add(UserSegment(title=u'First', filter_set=_filter_set(2)))
+        second, other = self.second
+        other_added = other.add(UserSegment(title=u'Second', filter_set=_filter_set(3)))
+        first.commit()
+        second.commit()
+
+        container = self._current()
+        assert_that(container, has_length(3))
+        assert_that(list(container.keys()),
+                    contains_inanyorder(self.segment_id, added.id, other_added.id))
+        # Both are tracked as depending on unknown indexes
+        assert_that(list(container._unknown_dependents),
+                    contains_inanyorder(self.segment_id, added.id, other_added.id))
+
+    def test_concurrent_statistics(self):
+        for _, container in (self.first, self.second):
+            storage = get_statistics_storage(container)
+            storage.get(self.segment_id).record(1, {'': 1}, 1.0)
+        self.first[0].commit()
+        self.second[0].commit()
+
+        statistics = get_statistics_storage(self._current()).get(self.segment_id)
+        assert_that(statistics, has_properties(evaluations=3, last_size=1))
+        assert_that(statistics.durations, contains(0.5, 1.0, 1.0))
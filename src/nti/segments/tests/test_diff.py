@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from unittest import TestCase
+
+import BTrees
+
+from hamcrest import assert_that
+from hamcrest import contains
+from hamcrest import has_length
+from hamcrest import has_properties
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import same_instance
+
+from nti.segments.diff import diff_segment
+
+from nti.segments.interfaces import ISegmentMembershipDiff
+from nti.segments.interfaces import ISegmentMembershipSnapshots
+
+from nti.segments.model import IntIdSet
+from nti.segments.model import IntersectionUserFilterSet
+from nti.segments.model import UnionUserFilterSet
+from nti.segments.model import UserSegment
+
+from nti.segments.tests import SharedConfiguringTestLayer
+
+from nti.segments.tests.test_model import TestFilterSet
+
+from nti.testing.matchers import verifiably_provides
+
+
+class TestDiffSegment(TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def test_diff_segment(self):
+        leaf = TestFilterSet([1, 2, 3])
+        segment = UserSegment(title=u'Segment', filter_set=IntersectionUserFilterSet(
+            filter_sets=(UnionUserFilterSet(filter_sets=(leaf,)),)))
+        initial = IntIdSet(BTrees.family64.IF.Set(range(10)))
+
+        diff = diff_segment(segment, initial, u'mailer')
+        assert_that(diff, verifiably_provides(ISegmentMembershipDiff))
+        assert_that(diff.added.intids(), contains(1, 2, 3))
+        assert_that(diff.removed.intids(), has_length(0))
+        assert_that(ISegmentMembershipSnapshots(segment).get(u'mailer'),
+                    is_(same_instance(diff.result)))
+        # The published result is left alone
+        assert_that(segment.result, is_(none()))
+
+        leaf.ids = (2, 3, 4, 5)
+        diff = diff_segment(segment, initial, u'mailer')
+        assert_that(diff.added.intids(), contains(4, 5))
+        assert_that(diff.removed.intids(), contains(1))
+        assert_that(diff.result, has_properties(size=4,
+                                                intids=contains(2, 3, 4, 5)))
+
+        diff = diff_segment(segment, initial, u'mailer')
+        assert_that(diff.added.intids(), has_length(0))
+        assert_that(diff.removed.intids(), has_length(0))
+
+    def test_consumers(self):
+        leaf = TestFilterSet([1, 2])
+        segment = UserSegment(title=u'Segment', filter_set=IntersectionUserFilterSet(
+            filter_sets=(UnionUserFilterSet(filter_sets=(leaf,)),)))
+        initial = IntIdSet(BTrees.family64.IF.Set(range(10)))
+        diff_segment(segment, initial, u'mailer')
+
+        leaf.ids = (2, 3)
+        diff = diff_segment(segment, initial, u'webhook')
+        assert_that(diff.added.intids(), contains(2, 3))
+        # Another consumer's diff doesn't hide the change from this one
+        diff = diff_segment(segment, initial, u'mailer')
+        assert_that(diff.added.intids(), contains(3))
+        assert_that(diff.removed.intids(), contains(1))
+
+        ISegmentMembershipSnapshots(segment).remove(u'mailer')
+        diff = diff_segment(segment, initial, u'mailer')
+        assert_that(diff.added.intids(), contains(2, 3))
+
+    def test_no_filter_set(self):
+        segment = UserSegment(title=u'Segment')
+        ISegmentMembershipSnapshots(segment).replace(u'mailer',
+                                                     BTrees.family64.IF.Set([1]))
+        diff = diff_segment(segment, IntIdSet(BTrees.family64.IF.Set(range(10))),
+                            u'mailer')
+        assert_that(diff.added.intids(), has_length(0))
+        assert_that(diff.removed.intids(), contains(1))
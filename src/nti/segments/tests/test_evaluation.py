@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from unittest import TestCase
+
+import BTrees
+
+from hamcrest import assert_that
+from hamcrest import calling
+from hamcrest import contains
+from hamcrest import has_properties
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import raises
+from hamcrest import same_instance
+
+from nti.segments.evaluation import EvaluationBudgetExceeded
+from nti.segments.evaluation import EvaluationCancelled
+from nti.segments.evaluation import cached_catalog_read
+from nti.segments.evaluation import checkpoint
+from nti.segments.evaluation import current_evaluation
+from nti.segments.evaluation import evaluate
+from nti.segments.evaluation import evaluation
+
+from nti.segments.model import IntIdSet
+from nti.segments.model import UnionUserFilterSet
+
+from nti.segments.tests import SharedConfiguringTestLayer
+
+from nti.segments.tests.test_model import TestFilterSet
+
+
+class TestEvaluation(TestCase):
+
+    def test_context(self):
+        assert_that(current_evaluation(), is_(none()))
+        with evaluation() as outer:
+            assert_that(current_evaluation(), is_(same_instance(outer)))
+            with evaluation() as inner:
+                assert_that(current_evaluation(), is_(same_instance(inner)))
+            assert_that(current_evaluation(), is_(same_instance(outer)))
+        assert_that(current_evaluation(), is_(none()))
+
+    def test_cached_catalog_read(self):
+        reads = []
+
+        def read():
+            reads.append(1)
+            return len(reads)
+
+        assert_that(cached_catalog_read('key', read), is_(1))
+        assert_that(cached_catalog_read('key', read), is_(2))
+
+        with evaluation():
+            assert_that(cached_catalog_read('key', read), is_(3))
+            assert_that(cached_catalog_read('key', read), is_(3))
+            assert_that(cached_catalog_read('other', read), is_(4))
+
+    def test_checkpoint(self):
+        checkpoint(self)
+        with evaluation() as context:
+            checkpoint(self)
+            context.cancel()
+            assert_that(calling(checkpoint).with_args(self),
+                        raises(EvaluationCancelled))
+
+
+class TestEvaluate(TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def setUp(self):
+        self.initial = IntIdSet(BTrees.family64.IF.Set(range(10)))
+        self.filter_set = UnionUserFilterSet(filter_sets=(TestFilterSet([1, 2, 3]),
+                                                          TestFilterSet([4, 5]),
+                                                          TestFilterSet([6]),))
+
+    def test_within_budget(self):
+        result = evaluate(self.filter_set, self.initial, timeout=60, max_intids=8)
+        assert_that(result.intids(), contains(1, 2, 3, 4, 5, 6))
+
+    def test_max_intids(self):
+        # The running union holds 3 intids before the second child, 5 before the third
+        assert_that(calling(evaluate).with_args(self.filter_set, self.initial,
+                                                max_intids=7),
+                    raises(EvaluationBudgetExceeded,
+                           "Evaluation budget exceeded"))
+        try:
+            evaluate(self.filter_set, self.initial, max_intids=7)
+        except EvaluationBudgetExceeded as e:
+            assert_that(e, has_properties(filter_set=self.filter_set,
+                                          processed=8))
+
+    def test_deadline(self):
+        assert_that(calling(evaluate).with_args(self.filter_set, self.initial,
+                                                timeout=-1),
+                    raises(EvaluationBudgetExceeded))
+        try:
+            evaluate(self.filter_set, self.initial, timeout=-1)
+        except EvaluationBudgetExceeded as e:
+            # Stopped at the first checkpoint, after the first child
+            assert_that(e, has_properties(filter_set=self.filter_set,
+                                          processed=3))
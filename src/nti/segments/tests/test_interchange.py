@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import random
+import shutil
+import struct
+import tempfile
+
+from unittest import TestCase
+
+import BTrees
+
+from hamcrest import assert_that
+from hamcrest import calling
+from hamcrest import contains
+from hamcrest import has_length
+from hamcrest import is_
+from hamcrest import less_than
+from hamcrest import raises
+
+from nti.segments.interchange import COMPRESSED
+from nti.segments.interchange import HEADER_SIZE
+from nti.segments.interchange import dump
+from nti.segments.interchange import dumps
+from nti.segments.interchange import load_mapped
+from nti.segments.interchange import loads
+from nti.segments.interchange import read_header
+from nti.segments.interchange import view
+
+from nti.segments.model import IntIdSet
+
+IF = BTrees.family64.IF
+
+
+class TestInterchange(TestCase):
+
+    intids = IF.Set([-3, 0, 7, 2 ** 40] + list(range(100, 1100)))
+
+    def test_round_trip(self):
+        for compress in (False, True):
+            buf = dumps(IntIdSet(self.intids), compress=compress)
+            assert_that(read_header(buf),
+                        is_((COMPRESSED if compress else 0, len(self.intids))))
+            assert_that(list(view(buf)), is_(list(self.intids)))
+            assert_that(list(loads(buf).intids()), is_(list(self.intids)))
+
+        assert_that(list(loads(dumps(IF.Set())).intids()), has_length(0))
+
+    def test_full_range(self):
+        rng = random.Random(42)
+        for intids in (IF.Set([-2 ** 63, 2 ** 63 - 1]),
+                       IF.Set(rng.randint(-2 ** 63, 2 ** 63 - 1) for _ in range(1000))):
+            buf = dumps(intids, compress=True)
+            assert_that(list(view(buf)), is_(list(intids)))
+            # Sparse sets cost no more than the uncompressed form
+            assert_that(len(buf), less_than(len(dumps(intids)) + 16))
+
+    def test_sizes(self):
+        raw = dumps(self.intids)
+        assert_that(raw, has_length(HEADER_SIZE + 8 * len(self.intids)))
+        # Dense runs compress well
+        assert_that(len(dumps(self.intids, compress=True)), less_than(len(raw) // 10))
+
+    def test_view_shares_memory(self):
+        buf = bytearray(dumps(IF.Set([1, 2, 3])))
+        intids = view(buf)
+        assert_that(intids, contains(1, 2, 3))
+        buf[HEADER_SIZE] = 9
+        assert_that(intids, contains(9, 2, 3))
+
+    def test_invalid(self):
+        assert_that(calling(view).with_args(b'NTIS'), raises(ValueError))
+        assert_that(calling(view).with_args(b'X' * HEADER_SIZE),
+                    raises(ValueError, "Not an intid set"))
+        buf = bytearray(dumps(IF.Set()))
+        buf[4] = 99
+        assert_that(calling(view).with_args(bytes(buf)),
+                    raises(ValueError, "Unsupported"))
+
+    def test_count_mismatch(self):
+        buf = dumps(IF.Set([1, 2, 3]))
+        assert_that(calling(view).with_args(buf[:-8]),
+                    raises(ValueError, "Expected 3 intids, found 2"))
+        buf = bytearray(dumps(IF.Set([1, 2, 3]), compress=True))
+        struct.pack_into('<Q', buf, 8, 4)
+        assert_that(calling(view).with_args(bytes(buf)),
+                    raises(ValueError, "Expected 4 intids, found 3"))
+
+    def test_load_mapped(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'intids')
+        with open(path, 'wb') as f:
+            dump(self.intids, f)
+        with load_mapped(path) as mapped:
+            assert_that(list(mapped.intids), is_(list(self.intids)))
@@ -11,6 +11,10 @@ from unittest import TestCase
 
 import BTrees
 
+import fudge
+
+import transaction
+
 from hamcrest import all_of
 from hamcrest import assert_that
 from hamcrest import calling
@@ -23,38 +27,63 @@ from hamcrest import has_length
 from hamcrest import has_properties
 from hamcrest import is_
 from hamcrest import is_not
+from hamcrest import matches_regexp
 from hamcrest import none
 from hamcrest import not_none
 from hamcrest import raises
+from hamcrest import same_instance
 
 from z3c.baseregistry.baseregistry import BaseComponents
 
+from zope import component
 from zope import interface
 
 from zope.component import globalSiteManager as BASE
 
+from zope.component.hooks import site as current_site
+
 from zope.container.interfaces import InvalidItemType
 
+from zope.event import notify
+
+from zope.intid.interfaces import IIntIds
+
+from zope.lifecycleevent import ObjectModifiedEvent
+
 from nti.externalization import update_from_external_object
 
 from nti.externalization.internalization import find_factory_for
 
 from nti.externalization.tests import externalizes
 
+from nti.coremetadata.interfaces import IX_IS_DEACTIVATED
+from nti.coremetadata.interfaces import IX_TOPICS
+
+from nti.dataserver.interfaces import IEntity
+
+from nti.segments.interfaces import IDifferenceUserFilterSet
 from nti.segments.interfaces import IIntersectionUserFilterSet
+from nti.segments.interfaces import INotUserFilterSet
 from nti.segments.interfaces import ISegmentsContainer
 from nti.segments.interfaces import IUnionUserFilterSet
 from nti.segments.interfaces import IUserSegment
+from nti.segments.interfaces import IndexesModifiedEvent
 
+from nti.segments.model import DifferenceUserFilterSet
+from nti.segments.model import filter_set_dependencies
 from nti.segments.model import install_segments_container
 from nti.segments.model import IntIdSet
 from nti.segments.model import IntersectionUserFilterSet
+from nti.segments.model import IsDeactivatedFilterSet
+from nti.segments.model import NotUserFilterSet
 from nti.segments.model import UnionUserFilterSet
 from nti.segments.model import UserSegment
 from nti.segments.model import SegmentsContainer
 
 from nti.segments.tests import SharedConfiguringTestLayer
 
+from nti.segments.subscribers import _on_entity_modified
+
 from nti.segments.tests.interfaces import ITestUserFilterSet
 
 from nti.site.folder import HostPolicyFolder
@@ -75,6 +104,32 @@ class MockSite(object):
         return self.site_man
 
 
+@interface.implementer(IEntity)
+class MockEntity(object):
+    pass
+
+
+class MockIntIds(object):
+
+    def queryId(self, ob):
+        return 1 if isinstance(ob, MockEntity) else None
+
+
+class MockTopicFilter(object):
+
+    def __init__(self):
+        self.ids = set()
+
+    def getIds(self):
+        return self.ids
+
+
+class MockTopicIndex(object):
+
+    def __init__(self, filters):
+        self._filters = filters
+
+
 @interface.implementer(ITestUserFilterSet)
 class TestFilterSet(object):
     mimeType = mime_type = "application/vnd.nextthought.segments.test.testfilterset"
@@ -117,6 +172,55 @@ class TestModel(TestCase):
         container.remove(segment_two.id)
         assert_that(container, has_length(is_(0)))
 
+    def test_allocated_ids(self):
+        container = SegmentsContainer()
+        ids = set()
+        for _ in range(50):
+            segment = container.add(UserSegment(title=u'Segment'))
+            assert_that(segment.id, matches_regexp('^[0-9a-f]{16}$'))
+            ids.add(segment.id)
+        assert_that(ids, has_length(50))
+
+        # Explicit ids are kept
+        segment = UserSegment(title=u'Named')
+        segment.id = u'named'
+        container.add(segment)
+        assert_that(container[u'named'], is_(segment))
+
+    def test_lookup(self):
+        container = SegmentsContainer()
+        segment = UserSegment(title=u'Named')
+        segment.id = u'Named'
+        container.add(segment)
+        assert_that(container._by_id, has_key(u'named'))
+        for key in (u'named', u'NAMED', u'Named'):
+            assert_that(key in container, is_(True))
+            assert_that(container[key], is_(same_instance(segment)))
+            assert_that(container.get(key), is_(same_instance(segment)))
+        assert_that(container.get(u'other'), is_(none()))
+        assert_that(calling(container.__getitem__).with_args(u'other'),
+                    raises(KeyError))
+
+        del container[u'NAMED']
+        assert_that(u'named' in container, is_(False))
+        assert_that(container._by_id, has_length(0))
+
+        # Containers from before ids were indexed
+        container._by_id = None
+        container.add(segment)
+        assert_that(container[u'named'], is_(same_instance(segment)))
+
+    def test_intid_set_family(self):
+        family = BTrees.family32
+        first = IntIdSet(family.IF.Set([1, 2, 3]), family)
+        second = family.IF.Set([2, 3, 4])
+        for result in (first.union(second),
+                       first.intersection(second),
+                       first.difference(second)):
+            assert_that(result.family, is_(family))
+        assert_that(list(first.intersection(second).union(second).intids()),
+                    contains(2, 3, 4))
+
     def test_install_container(self):
         pers_comps = BaseComponents(BASE, 'persistent', (BASE,))
         host_comps = BaseComponents(BASE, 'example.com', (BASE,))
@@ -139,6 +243,175 @@ class TestModel(TestCase):
         site_policy.unregisterUtility(container, ISegmentsContainer)
         del site_policy['default']['segments-container']
 
+    def test_mark_dirty(self):
+        deactivated = IsDeactivatedFilterSet(Deactivated=False)
+        tracked = UserSegment(title=u'Tracked', filter_set=IntersectionUserFilterSet(
+            filter_sets=(UnionUserFilterSet(filter_sets=(deactivated,)),)))
+        untracked = UserSegment(title=u'Untracked', filter_set=IntersectionUserFilterSet(
+            filter_sets=(UnionUserFilterSet(filter_sets=(deactivated,
+                                                         TestFilterSet([1]))),)))
+        empty = UserSegment(title=u'Empty')
+
+        assert_that(filter_set_dependencies(tracked.filter_set),
+                    is_(frozenset((IX_IS_DEACTIVATED,))))
+        assert_that(filter_set_dependencies(untracked.filter_set), is_(none()))
+        assert_that(filter_set_dependencies(empty.filter_set), is_(frozenset()))
+
+        container = SegmentsContainer()
+        for segment in (tracked, untracked, empty):
+            container.add(segment)
+            segment.dirty = False
+
+        # Unknown dependencies are affected by any index
+        assert_that(container.mark_dirty(('unrelated',)),
+                    contains(untracked))
+        assert_that(tracked.dirty, is_(False))
+
+        untracked.dirty = False
+        assert_that(container.mark_dirty((IX_IS_DEACTIVATED,)),
+                    contains_inanyorder(tracked, untracked))
+        assert_that(empty.dirty, is_(False))
+
+        # Already dirty segments are marked again
+        assert_that(container.mark_dirty((IX_IS_DEACTIVATED,)), has_length(2))
+
+    def test_changed_during_evaluation(self):
+        segment = UserSegment(title=u'Tracked', filter_set=IntersectionUserFilterSet(
+            filter_sets=(UnionUserFilterSet(
+                filter_sets=(IsDeactivatedFilterSet(Deactivated=True),)),)))
+        container = SegmentsContainer()
+        container.add(segment)
+        assert_that(segment.dirty, is_(True))
+
+        # A refresh starts, and the index changes before it publishes
+        generation = segment.generation
+        container.mark_dirty((IX_IS_DEACTIVATED,))
+        segment.publish_result(BTrees.family64.IF.Set(), generation)
+        assert_that(segment.dirty, is_(True))
+
+        segment.publish_result(BTrees.family64.IF.Set(), segment.generation)
+        assert_that(segment.dirty, is_(False))
+        # An older result doesn't make it dirty again
+        segment.publish_result(BTrees.family64.IF.Set(), generation)
+        assert_that(segment.dirty, is_(False))
+
+    def test_indexes_modified_event(self):
+        segment = UserSegment(title=u'Tracked', filter_set=IntersectionUserFilterSet(
+            filter_sets=(UnionUserFilterSet(
+                filter_sets=(IsDeactivatedFilterSet(Deactivated=True),)),)))
+        container = SegmentsContainer()
+        container.add(segment)
+        segment.dirty = False
+
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(container, ISegmentsContainer)
+        try:
+            notify(IndexesModifiedEvent(('unrelated',)))
+            assert_that(segment.dirty, is_(False))
+
+            notify(IndexesModifiedEvent((IX_IS_DEACTIVATED,)))
+            assert_that(segment.dirty, is_(True))
+        finally:
+            gsm.unregisterUtility(container, ISegmentsContainer)
+
+
+    def test_dependency_index(self):
+        deactivated = UnionUserFilterSet(
+            filter_sets=(IsDeactivatedFilterSet(Deactivated=True),))
+        tracked = UserSegment(title=u'Tracked', filter_set=IntersectionUserFilterSet(
+            filter_sets=(deactivated,)))
+        untracked = UserSegment(title=u'Untracked', filter_set=IntersectionUserFilterSet(
+            filter_sets=(UnionUserFilterSet(filter_sets=(TestFilterSet([1]),)),)))
+        container = SegmentsContainer()
+        container.add(tracked)
+        # Segments set directly are indexed too
+        untracked.id = u'untracked'
+        container[untracked.id] = untracked
+        for segment in (tracked, untracked):
+            segment.dirty = False
+
+        container.remove(untracked)
+        assert_that(container.mark_dirty(('unrelated',)), has_length(0))
+
+        # Replacing the filter set changes the dependencies
+        tracked.filter_set = IntersectionUserFilterSet(filter_sets=(
+            UnionUserFilterSet(filter_sets=(TestFilterSet([1]),)),))
+        notify(ObjectModifiedEvent(tracked))
+        assert_that(container.mark_dirty(('unrelated',)), contains(tracked))
+
+        tracked.filter_set = IntersectionUserFilterSet(filter_sets=(deactivated,))
+        container.index_dependencies(tracked)
+        tracked.dirty = False
+        assert_that(container.mark_dirty(('unrelated',)), has_length(0))
+
+        container.remove(tracked)
+        assert_that(container.mark_dirty((IX_IS_DEACTIVATED,)), has_length(0))
+
+    def _host_site(self, name):
+        host_comps = BaseComponents(BASE, name, (BASE,))
+        site = HostPolicyFolder()
+        site.__name__ = name
+        site_policy = HostPolicySiteManager(site)
+        site_policy.__bases__ = (host_comps,)
+        site.setSiteManager(site_policy)
+        segment = UserSegment(title=u'Tracked', filter_set=IntersectionUserFilterSet(
+            filter_sets=(UnionUserFilterSet(
+                filter_sets=(IsDeactivatedFilterSet(Deactivated=True),)),)))
+        container = SegmentsContainer()
+        container.add(segment)
+        segment.dirty = False
+        site_policy.registerUtility(container, ISegmentsContainer)
+        self.addCleanup(site_policy.unregisterUtility, container, ISegmentsContainer)
+        return site, segment
+
+    @fudge.patch('nti.segments.subscribers.get_entity_catalog',
+                 'nti.segments.subscribers.get_all_host_sites')
+    def test_entity_modified(self, mock_catalog, mock_sites):
+        deactivated = MockTopicFilter()
+        catalog = {IX_TOPICS: MockTopicIndex({IX_IS_DEACTIVATED: deactivated}),
+                   'unreadable': object()}
+        mock_catalog.is_callable().returns(catalog)
+        intids = MockIntIds()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(intids, IIntIds)
+        self.addCleanup(gsm.unregisterUtility, intids, IIntIds)
+
+        first, first_segment = self._host_site('first.example.com')
+        second, second_segment = self._host_site('second.example.com')
+        mock_sites.is_callable().returns([first, second])
+        entity = MockEntity()
+
+        # Reindexing that leaves the filters alone doesn't dirty anything
+        transaction.begin()
+        _on_entity_modified(entity, None)
+        transaction.commit()
+        assert_that(first_segment.dirty, is_(False))
+        assert_that(second_segment.dirty, is_(False))
+
+        # Only the containers visible from the site the entity changed in
+        transaction.begin()
+        with current_site(first):
+            _on_entity_modified(entity, None)
+            deactivated.ids.add(intids.queryId(entity))
+            _on_entity_modified(entity, None)
+        transaction.commit()
+        assert_that(first_segment.dirty, is_(True))
+        assert_that(second_segment.dirty, is_(False))
+
+        # Without a site, every site's containers
+        first_segment.dirty = False
+        transaction.begin()
+        _on_entity_modified(entity, None)
+        deactivated.ids.clear()
+        transaction.commit()
+        assert_that(first_segment.dirty, is_(True))
+        assert_that(second_segment.dirty, is_(True))
+
+        # Entities without intids aren't indexed
+        transaction.begin()
+        _on_entity_modified(object(), None)
+        transaction.commit()
+
 
 class TestUnionUserFilterSet(TestCase):
 
@@ -340,6 +613,80 @@ class TestIntersectionUserFilterSet(TestCase):
         assert_that(result.intids(), contains_inanyorder(2, 3))
 
 
+class TestNotUserFilterSet(TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def test_valid_interface(self):
+        assert_that(NotUserFilterSet(filter_set=TestFilterSet()),
+                    verifiably_provides(INotUserFilterSet))
+
+    def test_internalize(self):
+        ext_obj = {
+            "MimeType": NotUserFilterSet.mime_type,
+            "filter_set": {
+                "MimeType": TestFilterSet.mime_type,
+                "ids": [1, 2]
+            },
+        }
+        factory = find_factory_for(ext_obj)
+        filter_set = factory()
+        update_from_external_object(filter_set, ext_obj)
+        assert_that(filter_set, has_properties(
+            mime_type=NotUserFilterSet.mime_type,
+            filter_set=has_properties(ids=[1, 2])
+        ))
+
+    def test_apply(self):
+        initial = IntIdSet(BTrees.family64.IF.Set([1, 2, 3, 4, 5]))
+        filter_set = NotUserFilterSet(filter_set=TestFilterSet([2, 3, 6]))
+        assert_that(filter_set.apply(initial).intids(),
+                    contains(1, 4, 5))
+
+        # Negations may be intersected directly
+        intersection = IntersectionUserFilterSet(filter_sets=(
+            UnionUserFilterSet(filter_sets=(TestFilterSet([1, 2, 3]),)),
+            filter_set,
+        ))
+        assert_that(intersection.apply(initial).intids(), contains(1))
+
+
+class TestDifferenceUserFilterSet(TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def test_valid_interface(self):
+        assert_that(DifferenceUserFilterSet(filter_set=TestFilterSet(),
+                                            excluded_filter_set=TestFilterSet()),
+                    verifiably_provides(IDifferenceUserFilterSet))
+
+    def test_externalize(self):
+        filter_set = DifferenceUserFilterSet(filter_set=TestFilterSet([1, 2]),
+                                             excluded_filter_set=TestFilterSet([2]))
+        assert_that(filter_set,
+                    externalizes(has_entries({
+                        'MimeType': DifferenceUserFilterSet.mime_type,
+                        'filter_set': has_entries(ids=[1, 2]),
+                        'excluded_filter_set': has_entries(ids=[2]),
+                    })))
+
+    def test_apply(self):
+        initial = IntIdSet(BTrees.family64.IF.Set([1, 2, 3, 4, 5]))
+        filter_set = DifferenceUserFilterSet(
+            filter_set=UnionUserFilterSet(filter_sets=(TestFilterSet([1, 2]),
+                                                       TestFilterSet([3, 4]))),
+            excluded_filter_set=TestFilterSet([2, 4]))
+        assert_that(filter_set.apply(initial).intids(), contains(1, 3))
+
+        assert_that(filter_set.dependencies, is_(none()))
+        filter_set = DifferenceUserFilterSet(
+            filter_set=IsDeactivatedFilterSet(Deactivated=False),
+            excluded_filter_set=NotUserFilterSet(
+                filter_set=IsDeactivatedFilterSet(Deactivated=True)))
+        assert_that(filter_set.dependencies,
+                    is_(frozenset((IX_IS_DEACTIVATED,))))
+
+
 class TestUserSegment(TestCase):
 
     layer = SharedConfiguringTestLayer
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from unittest import TestCase
+
+import BTrees
+
+from hamcrest import assert_that
+from hamcrest import contains
+from hamcrest import is_
+
+from nti.segments.interfaces import ISegmentOverlapMatrix
+
+from nti.segments.model import IntIdSet
+from nti.segments.model import IntersectionUserFilterSet
+from nti.segments.model import SegmentsContainer
+from nti.segments.model import UnionUserFilterSet
+from nti.segments.model import UserSegment
+
+from nti.segments.overlap import overlap_matrix
+
+from nti.segments.tests import SharedConfiguringTestLayer
+
+from nti.segments.tests.test_model import TestFilterSet
+
+from nti.testing.matchers import verifiably_provides
+
+
+def _segment(container, ids):
+    return container.add(UserSegment(title=u'Segment', filter_set=IntersectionUserFilterSet(
+        filter_sets=(UnionUserFilterSet(filter_sets=(TestFilterSet(ids),)),))))
+
+
+class TestOverlapMatrix(TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def setUp(self):
+        container = SegmentsContainer()
+        self.first = _segment(container, range(0, 100))
+        self.second = _segment(container, range(50, 200))
+        self.third = _segment(container, range(300, 310))
+        self.segments = (self.first, self.second, self.third,
+                         container.add(UserSegment(title=u'Empty')))
+        self.initial = IntIdSet(BTrees.family64.IF.Set(range(1000)))
+
+    def test_exact(self):
+        matrix = overlap_matrix(self.segments, self.initial)
+        assert_that(matrix, verifiably_provides(ISegmentOverlapMatrix))
+        assert_that(matrix.estimated, is_(False))
+        assert_that(matrix.segment_ids, contains(self.first.id, self.second.id,
+                                                 self.third.id))
+        assert_that(matrix.overlap(self.first.id, self.second.id), is_(50))
+        assert_that(matrix.overlap(self.second.id, self.first.id), is_(50))
+        assert_that(matrix.rows(), contains(contains(100, 50, 0),
+                                            contains(50, 150, 0),
+                                            contains(0, 0, 10)))
+
+    def test_estimated(self):
+        matrix = overlap_matrix(self.segments, self.initial, sketch_size=64)
+        assert_that(matrix.estimated, is_(True))
+        assert_that(matrix.overlap(self.first.id, self.first.id), is_(100))
+        # Disjoint sets have no hashes in common
+        assert_that(matrix.overlap(self.first.id, self.third.id), is_(0))
+        estimate = matrix.overlap(self.first.id, self.second.id)
+        assert_that(20 <= estimate <= 80, is_(True))
+
+        # Sketches holding every hash are exact
+        matrix = overlap_matrix(self.segments, self.initial, sketch_size=256)
+        assert_that(matrix.overlap(self.first.id, self.second.id), is_(50))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import itertools
+import random
+
+from unittest import TestCase
+
+import BTrees
+
+from hamcrest import assert_that
+from hamcrest import contains
+from hamcrest import every_item
+from hamcrest import has_length
+from hamcrest import is_
+from hamcrest import same_instance
+
+from nti.segments.evaluation import EvaluationContext
+from nti.segments.evaluation import evaluation
+
+from nti.segments.model import IntIdSet
+from nti.segments.model import UnionUserFilterSet
+
+from nti.segments.sampling import _population
+from nti.segments.sampling import _shuffled
+from nti.segments.sampling import first_members
+from nti.segments.sampling import sample_members
+
+from nti.segments.tests import SharedConfiguringTestLayer
+
+from nti.segments.tests.test_model import TestFilterSet
+
+
+class CountingFilterSet(TestFilterSet):
+
+    applied = 0
+
+    def apply(self, initial_set):
+        self.applied += 1
+        return TestFilterSet.apply(self, initial_set)
+
+
+class TestSampling(TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def setUp(self):
+        self.leaf = CountingFilterSet(range(0, 10000, 3))
+        self.filter_set = UnionUserFilterSet(filter_sets=(self.leaf,))
+        self.initial = IntIdSet(BTrees.family64.IF.Set(range(1, 10000)))
+
+    def test_first_members(self):
+        result = first_members(self.filter_set, self.initial, 5, chunk_size=4)
+        assert_that(list(result.intids()), contains(3, 6, 9, 12, 15))
+        # Chunks of 4, 8 and 16 intids were enough
+        assert_that(self.leaf.applied, is_(3))
+
+        result = first_members(self.filter_set, self.initial, 10000)
+        assert_that(result, has_length(3333))
+
+    def test_sample_members(self):
+        result = sample_members(self.filter_set, self.initial, 10,
+                                rng=random.Random(42))
+        assert_that(result, has_length(10))
+        assert_that([intid % 3 for intid in result.intids()], every_item(is_(0)))
+        assert_that(self.leaf.applied, is_(1))
+
+    def test_shuffled(self):
+        intids = BTrees.family64.IF.Set(range(100))
+        chunks = list(_shuffled(intids, 8, random.Random(1)))
+        assert_that([len(chunk) for chunk in chunks], contains(8, 16, 32, 44))
+        # A permutation of the population
+        assert_that(sorted(itertools.chain(*chunks)), is_(list(range(100))))
+
+        # The population is copied once per evaluation
+        with evaluation(EvaluationContext()):
+            population = _population(intids)
+            next(_shuffled(intids, 8, random.Random(2)))
+            assert_that(_population(intids), is_(same_instance(population)))
+        intids.add(100)
+        with evaluation(EvaluationContext()):
+            assert_that(_population(intids), has_length(101))
+
+        chunks = list(_shuffled(list(range(10)), 4, random.Random(1)))
+        assert_that(sorted(itertools.chain(*chunks)), is_(list(range(10))))
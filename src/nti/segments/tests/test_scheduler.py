@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+from unittest import TestCase
+
+import BTrees
+
+from hamcrest import assert_that
+from hamcrest import contains
+from hamcrest import contains_inanyorder
+from hamcrest import has_length
+from hamcrest import has_properties
+from hamcrest import is_
+from hamcrest import none
+
+from nti.segments.model import IntIdSet
+from nti.segments.model import IntersectionUserFilterSet
+from nti.segments.model import SegmentsContainer
+from nti.segments.model import UnionUserFilterSet
+from nti.segments.model import UserSegment
+
+from nti.segments.scheduler import SegmentRefreshScheduler
+
+from nti.segments.tests import SharedConfiguringTestLayer
+
+from nti.segments.tests.test_model import TestFilterSet
+
+
+def _segment(title, ids):
+    filter_set = IntersectionUserFilterSet(
+        filter_sets=(UnionUserFilterSet(filter_sets=(TestFilterSet(ids),)),))
+    return UserSegment(title=title, filter_set=filter_set)
+
+
+class TestSegmentRefreshScheduler(TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def setUp(self):
+        self.container = SegmentsContainer()
+        self.first = self.container.add(_segment(u'First', [1, 2, 3]))
+        self.second = self.container.add(_segment(u'Second', [2, 3, 4]))
+        self.container.add(UserSegment(title=u'No Filter'))
+        population = IntIdSet(BTrees.family64.IF.Set(range(10)))
+        self.scheduler = SegmentRefreshScheduler(lambda: {'site': self.container},
+                                                 lambda unused_key: population,
+                                                 poll_interval=0.01)
+
+    def test_refresh(self):
+        assert_that(self.first.result, is_(none()))
+
+        refreshed = self.scheduler.run_cycle()
+        assert_that(refreshed, contains_inanyorder(self.first, self.second))
+        assert_that(self.first.result, has_properties(size=3, intids=contains(1, 2, 3)))
+        assert_that(self.first.dirty, is_(False))
+
+        # Nothing is due until something changes
+        assert_that(self.scheduler.run_cycle(), has_length(0))
+
+        self.second.dirty = True
+        assert_that(self.scheduler.run_cycle(), contains(self.second))
+
+        self.first.refresh_interval = 10
+        self.first.result.lastModified = time.time() - 11
+        assert_that(self.scheduler.run_cycle(), contains(self.first))
+
+    def test_priority(self):
+        self.scheduler.run_cycle()
+        self.first.dirty = self.second.dirty = True
+        self.scheduler.request('site', self.second.id)
+        self.scheduler.request('site', self.second.id)
+
+        self.scheduler._drain_requests()
+        due = self.scheduler._due(time.time())
+        assert_that([segment for _, _, segment in due],
+                    contains(self.second, self.first))
+
+    def test_budget(self):
+        self.scheduler.cycle_budget = 0
+        assert_that(self.scheduler.run_cycle(), has_length(0))
+        assert_that(self.first.result, is_(none()))
+
+    def test_thread(self):
+        self.scheduler.start()
+        try:
+            for _ in range(500):
+                if self.first.result is not None and self.second.result is not None:
+                    break
+                time.sleep(0.01)
+        finally:
+            self.scheduler.stop()
+        assert_that(self.second.result, has_properties(size=3))
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from unittest import TestCase
+from unittest import skipIf
+
+import BTrees
+
+from hamcrest import assert_that
+from hamcrest import contains
+from hamcrest import has_length
+from hamcrest import is_
+
+import fudge
+
+from zope import interface
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # pragma: no cover
+    ProcessPoolExecutor = ThreadPoolExecutor = None
+
+from nti.coremetadata.interfaces import IX_IS_DEACTIVATED
+from nti.coremetadata.interfaces import IX_TOPICS
+
+from nti.segments.evaluation import EvaluationContext
+from nti.segments.evaluation import evaluation
+from nti.segments.evaluation import range_slice
+
+from nti.segments.model import IntIdSet
+from nti.segments.model import IntersectionUserFilterSet
+from nti.segments.model import IsDeactivatedFilterSet
+from nti.segments.model import NotUserFilterSet
+from nti.segments.model import UnionUserFilterSet
+
+from nti.segments.sharding import evaluate_sharded
+from nti.segments.sharding import shard_ranges
+
+from nti.segments.tests import SharedConfiguringTestLayer
+
+from nti.segments.tests.interfaces import ITestUserFilterSet
+
+from nti.segments.tests.test_model import TestFilterSet
+
+IF = BTrees.family64.IF
+
+#: Set in worker processes by the initializer
+_prepared = {}
+
+
+def _prepare(ids):
+    _prepared['ids'] = ids
+
+
+@interface.implementer(ITestUserFilterSet)
+class PreparedFilterSet(object):
+
+    def apply(self, unused_initial_set):
+        # Fails unless the worker was initialized
+        return IntIdSet(IF.Set(_prepared['ids']))
+
+
+class _Catalog(dict):
+    family = BTrees.family64
+
+
+class TestShardRanges(TestCase):
+
+    def test_shard_ranges(self):
+        assert_that(shard_ranges(IF.Set(range(10)), 3),
+                    contains((0, 3), (4, 7), (8, 9)))
+        assert_that(shard_ranges(IF.TreeSet([2, 5, 9]), 8),
+                    contains((2, 2), (5, 5), (9, 9)))
+        assert_that(shard_ranges(IF.Set([7]), 1), contains((7, 7)))
+        assert_that(shard_ranges(IF.Set(), 4), has_length(0))
+
+
+@skipIf(ThreadPoolExecutor is None, "Requires concurrent.futures")
+class TestEvaluateSharded(TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def test_evaluate_sharded(self):
+        filter_set = IntersectionUserFilterSet(filter_sets=(
+            UnionUserFilterSet(filter_sets=(TestFilterSet(range(0, 100, 2)),
+                                            TestFilterSet([3, 5, 7]))),
+            NotUserFilterSet(filter_set=TestFilterSet(range(0, 100, 4))),
+        ))
+        initial = IntIdSet(IF.TreeSet(range(50)))
+        # Sharded results are limited to the population
+        expected = list(filter_set.apply(initial).intersection(initial).intids())
+
+        executor = ThreadPoolExecutor(max_workers=3)
+        try:
+            for shards in (1, 3, 7):
+                result = evaluate_sharded(filter_set, initial, shards, executor)
+                assert_that(list(result.intids()), is_(expected))
+        finally:
+            executor.shutdown()
+
+    def test_process_pool(self):
+        filter_set = UnionUserFilterSet(filter_sets=(TestFilterSet(range(0, 100, 3)),))
+        initial = IntIdSet(IF.TreeSet(range(50)))
+        result = evaluate_sharded(filter_set, initial, 2)
+        assert_that(list(result.intids()), is_(list(range(0, 50, 3))))
+
+    def test_initializer(self):
+        initial = IntIdSet(IF.TreeSet(range(10)))
+        executor = ProcessPoolExecutor(max_workers=2)
+        try:
+            result = evaluate_sharded(PreparedFilterSet(), initial, 2, executor,
+                                      initializer=_prepare, initargs=([2, 7, 20],))
+        finally:
+            executor.shutdown()
+        assert_that(list(result.intids()), contains(2, 7))
+
+
+class TestRangeSlice(TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    @fudge.patch('nti.segments.model.get_entity_catalog')
+    def test_range_slice(self, mock_catalog):
+        intids = IF.TreeSet(range(10))
+        assert_that(range_slice(intids), is_(intids))
+        with evaluation(EvaluationContext(intid_range=(3, 6))):
+            assert_that(list(range_slice(intids)), contains(3, 4, 5, 6))
+
+        index = fudge.Fake('Index').provides('getIds').returns(IF.TreeSet([1, 4, 8]))
+        mock_catalog.is_callable().returns(_Catalog({IX_TOPICS: {IX_IS_DEACTIVATED: index}}))
+        filter_set = IsDeactivatedFilterSet(Deactivated=True)
+        with evaluation(EvaluationContext(intid_range=(3, 9))):
+            assert_that(list(filter_set.deactivated_intids), contains(4, 8))
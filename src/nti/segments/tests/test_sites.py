@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from unittest import TestCase
+
+import BTrees
+
+from hamcrest import assert_that
+from hamcrest import contains
+from hamcrest import has_entries
+from hamcrest import has_key
+from hamcrest import has_length
+from hamcrest import is_not
+
+from z3c.baseregistry.baseregistry import BaseComponents
+
+from zope.component import globalSiteManager as BASE
+
+from nti.segments.interfaces import ISegmentsContainer
+
+from nti.segments.model import install_segments_container
+from nti.segments.model import IntIdSet
+from nti.segments.model import IntersectionUserFilterSet
+from nti.segments.model import UnionUserFilterSet
+from nti.segments.model import UserSegment
+
+from nti.segments.sites import evaluate_sites
+from nti.segments.sites import partition_population
+
+from nti.segments.tests import SharedConfiguringTestLayer
+
+from nti.segments.tests.test_model import TestFilterSet
+
+from nti.site.folder import HostPolicyFolder
+from nti.site.folder import HostPolicySiteManager
+
+
+def _intersection(ids):
+    return IntersectionUserFilterSet(
+        filter_sets=(UnionUserFilterSet(filter_sets=(TestFilterSet(ids),)),))
+
+
+class PopulationFilterSet(TestFilterSet):
+
+    def apply(self, initial_set):
+        return initial_set.intersection(BTrees.family64.IF.Set(self.ids))
+
+
+class TestEvaluateSites(TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def _make_site(self, name):
+        pers_comps = BaseComponents(BASE, 'persistent', (BASE,))
+        host_comps = BaseComponents(BASE, name, (BASE,))
+
+        site = HostPolicyFolder()
+        site.__name__ = name
+        site_policy = HostPolicySiteManager(site)
+        site_policy.__bases__ = (host_comps, pers_comps)
+        site.setSiteManager(site_policy)
+        container = install_segments_container(site)
+        self.addCleanup(self._remove_container, site_policy, container)
+        return site, container
+
+    def _remove_container(self, site_policy, container):
+        site_policy.unregisterUtility(container, ISegmentsContainer)
+        del site_policy['default']['segments-container']
+
+    def test_partition_population(self):
+        population = IntIdSet(BTrees.family64.IF.Set(range(10)))
+        partitions = partition_population(population, {
+            'a.com': BTrees.family64.IF.Set([1, 2, 11]),
+            'b.com': BTrees.family64.IF.Set([3]),
+        })
+        assert_that(partitions['a.com'].intids(), contains(1, 2))
+        assert_that(partitions['b.com'].intids(), contains(3))
+
+    def test_evaluate_sites(self):
+        site_a, container_a = self._make_site('a.com')
+        site_b, container_b = self._make_site('b.com')
+        site_c, unused_container_c = self._make_site('c.com')
+
+        segment_a = container_a.add(UserSegment(
+            title=u'A',
+            filter_set=IntersectionUserFilterSet(filter_sets=(
+                UnionUserFilterSet(filter_sets=(PopulationFilterSet([1, 2, 3, 4]),)),))))
+        container_b.add(UserSegment(title=u'Empty'))
+        segment_b = container_b.add(UserSegment(
+            title=u'B',
+            filter_set=_intersection([5, 6])))
+
+        population = IntIdSet(BTrees.family64.IF.Set(range(10)))
+        result = evaluate_sites((site_a, site_b, site_c), population, {
+            'a.com': BTrees.family64.IF.Set([1, 2, 5]),
+            'b.com': BTrees.family64.IF.Set([4, 5, 6]),
+        })
+
+        assert_that(result, has_entries({
+            'a.com': has_length(1),
+            'b.com': has_length(1),
+            'c.com': has_length(0),
+        }))
+        assert_that(result['a.com'][segment_a.id].intids(), contains(1, 2))
+        assert_that(result['b.com'][segment_b.id].intids(), contains(5, 6))
+
+    def test_inherited_container(self):
+        parent, container = self._make_site('parent.com')
+        container.add(UserSegment(title=u'Parent', filter_set=_intersection([1])))
+        child = HostPolicyFolder()
+        child.__name__ = 'child.com'
+        child_policy = HostPolicySiteManager(child)
+        child_policy.__bases__ = (parent.getSiteManager(),)
+        child.setSiteManager(child_policy)
+
+        population = IntIdSet(BTrees.family64.IF.Set(range(10)))
+        result = evaluate_sites((parent, child), population, {
+            'parent.com': BTrees.family64.IF.Set([1]),
+            'child.com': BTrees.family64.IF.Set([2]),
+        })
+        # The parent's segments aren't evaluated again for the child
+        assert_that(result, has_entries({'parent.com': has_length(1)}))
+        assert_that(result, is_not(has_key('child.com')))
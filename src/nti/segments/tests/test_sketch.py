@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from unittest import TestCase
+
+import BTrees
+
+from hamcrest import assert_that
+from hamcrest import contains
+from hamcrest import contains_inanyorder
+from hamcrest import has_length
+from hamcrest import is_
+from hamcrest import less_than
+from hamcrest import none
+
+from nti.segments.interfaces import IMembershipSketch
+
+from nti.segments.model import SegmentResult
+from nti.segments.model import UserSegment
+
+from nti.segments.sketch import BloomFilter
+from nti.segments.sketch import candidate_segments
+from nti.segments.sketch import segments_containing
+
+from nti.segments.tests import SharedConfiguringTestLayer
+
+from nti.testing.matchers import verifiably_provides
+
+IF = BTrees.family64.IF
+
+
+class TestBloomFilter(TestCase):
+
+    def test_membership(self):
+        intids = IF.Set(range(0, 20000, 2))
+        sketch = BloomFilter.from_intids(intids, error_rate=0.01)
+        assert_that(sketch, verifiably_provides(IMembershipSketch))
+        # No false negatives
+        assert_that(all(intid in sketch for intid in intids), is_(True))
+
+        false_positives = sum(1 for intid in range(1, 20000, 2) if intid in sketch)
+        assert_that(false_positives, less_than(300))
+
+    def test_empty(self):
+        sketch = BloomFilter.from_intids(IF.Set())
+        assert_that(1 in sketch, is_(False))
+
+
+class UnsketchedResult(object):
+
+    def __init__(self, intids):
+        self.intids = intids
+
+
+class TestSegmentSketches(TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def test_segments_containing(self):
+        first = UserSegment(title=u'First')
+        first.publish_result(IF.Set([1, 2, 3]))
+        second = UserSegment(title=u'Second')
+        second.publish_result(IF.Set(range(3, 1000)))
+        unevaluated = UserSegment(title=u'Unevaluated')
+        segments = (first, second, unevaluated)
+
+        assert_that(candidate_segments(segments, 3), contains_inanyorder(first, second))
+        assert_that(segments_containing(segments, 2), contains(first))
+        assert_that(segments_containing(segments, 3), contains_inanyorder(first, second))
+        assert_that(segments_containing(segments, 5000), has_length(0))
+
+        # Results without sketches are always candidates
+        second.result = UnsketchedResult(IF.Set(range(3, 1000)))
+        assert_that(candidate_segments(segments, 5000), contains(second))
+
+    def test_lazy_sketch(self):
+        result = SegmentResult(IF.Set([1, 2, 3]))
+        assert_that(result._sketch, is_(none()))
+        assert_that(2 in result.sketch, is_(True))
+        assert_that(result.sketch, is_(result._sketch))
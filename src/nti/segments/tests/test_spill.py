@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from unittest import TestCase
+
+import BTrees
+
+from hamcrest import assert_that
+from hamcrest import contains
+from hamcrest import has_length
+from hamcrest import instance_of
+from hamcrest import is_
+
+from nti.segments.model import IntIdSet
+from nti.segments.model import IntersectionUserFilterSet
+from nti.segments.model import NotUserFilterSet
+from nti.segments.model import UnionUserFilterSet
+
+from nti.segments.spill import SpillingIntIdSet
+from nti.segments.spill import evaluate_bounded
+
+from nti.segments.tests import SharedConfiguringTestLayer
+
+from nti.segments.tests.test_model import TestFilterSet
+
+IF = BTrees.family64.IF
+
+
+class PopulationFilterSet(TestFilterSet):
+
+    def apply(self, initial_set):
+        return initial_set.intersection(IF.Set(self.ids))
+
+
+class TestSpillingIntIdSet(TestCase):
+
+    def test_spill(self):
+        in_memory = SpillingIntIdSet(IF.Set(range(10)), budget=1024)
+        assert_that(in_memory.spilled, is_(False))
+        assert_that(in_memory, has_length(10))
+
+        spilled = SpillingIntIdSet(IF.Set(range(10)), budget=16)
+        assert_that(spilled.spilled, is_(True))
+        assert_that(list(spilled), is_(list(range(10))))
+        assert_that(list(spilled.intids()), is_(list(range(10))))
+
+        spilled.close()
+        assert_that(spilled, has_length(0))
+
+    def test_operations(self):
+        left = IF.Set(range(0, 100, 2))
+        right = IF.Set(range(0, 100, 3))
+        for budget in (16, 1024 * 1024):
+            result_set = SpillingIntIdSet(left, budget=budget)
+            for other in (right,
+                          IntIdSet(right),
+                          SpillingIntIdSet(right, budget=budget)):
+                assert_that(list(result_set.union(other)),
+                            is_(list(IF.union(left, right))))
+                assert_that(list(result_set.intersection(other)),
+                            is_(list(IF.intersection(left, right))))
+                assert_that(list(result_set.difference(other)),
+                            is_(list(IF.difference(left, right))))
+
+        empty = SpillingIntIdSet()
+        assert_that(list(empty.union(right)), is_(list(right)))
+        assert_that(list(empty.intersection(right)), has_length(0))
+
+
+class TestEvaluateBounded(TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def test_evaluate_bounded(self):
+        filter_set = IntersectionUserFilterSet(filter_sets=(
+            UnionUserFilterSet(filter_sets=(PopulationFilterSet(range(0, 50)),
+                                            PopulationFilterSet(range(100, 150)))),
+            NotUserFilterSet(filter_set=PopulationFilterSet(range(0, 200, 2))),
+        ))
+        initial = IntIdSet(IF.Set(range(120)))
+        result = evaluate_bounded(filter_set, initial, budget=64)
+        assert_that(result, instance_of(SpillingIntIdSet))
+        assert_that(list(result),
+                    is_(list(range(1, 50, 2)) + list(range(101, 120, 2))))
+        assert_that(result.intids(), contains(*result))
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from unittest import TestCase
+
+import BTrees
+
+import transaction
+
+from hamcrest import assert_that
+from hamcrest import contains
+from hamcrest import has_entry
+from hamcrest import has_length
+from hamcrest import has_properties
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import not_none
+
+from ZODB import DB
+
+from ZODB.MappingStorage import MappingStorage
+
+from ZODB.utils import u64
+
+from nti.segments.interfaces import ISegmentEvaluationStatistics
+from nti.segments.interfaces import ISegmentStatisticsStorage
+
+from nti.segments.model import IntIdSet
+from nti.segments.model import IntersectionUserFilterSet
+from nti.segments.model import SegmentsContainer
+from nti.segments.model import UnionUserFilterSet
+from nti.segments.model import UserSegment
+
+from nti.segments.stats import SegmentEvaluationStatistics
+from nti.segments.stats import costliest_segments
+from nti.segments.stats import evaluate_with_statistics
+from nti.segments.stats import get_statistics_storage
+
+from nti.segments.tests import SharedConfiguringTestLayer
+
+from nti.segments.tests.test_model import TestFilterSet
+
+from nti.testing.matchers import verifiably_provides
+
+
+class TestSegmentEvaluationStatistics(TestCase):
+
+    def test_record(self):
+        statistics = SegmentEvaluationStatistics()
+        assert_that(statistics, verifiably_provides(ISegmentEvaluationStatistics))
+        assert_that(statistics.p95_duration, is_(none()))
+
+        for duration in range(1, 21):
+            statistics.record(5, {'': 5}, duration / 10.0, generation=duration)
+        assert_that(statistics, has_properties(evaluations=20,
+                                               last_size=5,
+                                               last_duration=2.0,
+                                               p95_duration=1.9,
+                                               generation=20))
+
+        statistics.window = 5
+        statistics.record(1, {'': 1}, 0.1)
+        assert_that(statistics.durations, contains(1.7, 1.8, 1.9, 2.0, 0.1))
+
+
+class TestEvaluateWithStatistics(TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def test_evaluate_with_statistics(self):
+        container = SegmentsContainer()
+        segment = container.add(UserSegment(
+            title=u'Segment',
+            filter_set=IntersectionUserFilterSet(filter_sets=(
+                UnionUserFilterSet(filter_sets=(TestFilterSet([1, 2, 3]),
+                                                TestFilterSet([2, 3, 4]))),
+                UnionUserFilterSet(filter_sets=(TestFilterSet([2]),)),
+            ))))
+        cheap = container.add(UserSegment(
+            title=u'Cheap',
+            filter_set=IntersectionUserFilterSet(filter_sets=(
+                UnionUserFilterSet(filter_sets=(TestFilterSet([1]),)),))))
+        assert_that(get_statistics_storage(container, create=False), is_(none()))
+        assert_that(costliest_segments(container), has_length(0))
+
+        initial = IntIdSet(BTrees.family64.IF.Set(range(10)))
+        result = evaluate_with_statistics(segment, initial, generation=3)
+        assert_that(result.intids(), contains(2))
+
+        storage = get_statistics_storage(container, create=False)
+        assert_that(storage, verifiably_provides(ISegmentStatisticsStorage))
+        statistics = storage.get(segment.id)
+        assert_that(statistics, has_properties(evaluations=1,
+                                               last_size=1,
+                                               generation=3,
+                                               p95_duration=not_none()))
+        assert_that(statistics.node_cardinalities, has_entry('', 1))
+        assert_that(sorted(statistics.node_cardinalities.values()),
+                    contains(1, 1, 1, 3, 3, 4))
+
+        evaluate_with_statistics(cheap, initial)
+        storage.get(cheap.id).durations = (0,)
+        assert_that(costliest_segments(container, 1),
+                    contains(contains(segment.id, statistics)))
+
+        # Statistics go with the segment
+        container.remove(segment)
+        assert_that(storage.get(segment.id), is_(none()))
+
+    def test_default_generation(self):
+        db = DB(MappingStorage())
+        manager = transaction.TransactionManager()
+        connection = db.open(manager)
+        try:
+            container = connection.root()['segments'] = SegmentsContainer()
+            segment = container.add(UserSegment(
+                title=u'Segment',
+                filter_set=IntersectionUserFilterSet(filter_sets=(
+                    UnionUserFilterSet(filter_sets=(TestFilterSet([1]),)),))))
+            manager.commit()
+
+            snapshot = u64(db.lastTransaction())
+
+            # A commit the connection hasn't seen yet
+            other_manager = transaction.TransactionManager()
+            other = db.open(other_manager)
+            other.root()['other'] = 1
+            other_manager.commit()
+            other.close()
+
+            initial = IntIdSet(BTrees.family64.IF.Set(range(10)))
+            evaluate_with_statistics(segment, initial)
+            statistics = get_statistics_storage(container).get(segment.id)
+            assert_that(statistics.generation, is_(snapshot))
+
+            # Beginning a transaction aborts the statistics recorded so far
+            manager.begin()
+            evaluate_with_statistics(segment, initial)
+            statistics = get_statistics_storage(container).get(segment.id)
+            assert_that(statistics.generation, is_(u64(db.lastTransaction())))
+
+            evaluate_with_statistics(segment, initial, generation=7)
+            assert_that(statistics.generation, is_(7))
+        finally:
+            manager.abort()
+            connection.close()
+            db.close()
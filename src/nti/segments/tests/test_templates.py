@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from unittest import TestCase
+
+import BTrees
+
+from hamcrest import assert_that
+from hamcrest import calling
+from hamcrest import contains
+from hamcrest import is_
+from hamcrest import is_not
+from hamcrest import raises
+from hamcrest import same_instance
+
+from nti.segments.model import DifferenceUserFilterSet
+from nti.segments.model import IntIdSet
+from nti.segments.model import IntersectionUserFilterSet
+from nti.segments.model import NotUserFilterSet
+from nti.segments.model import UnionUserFilterSet
+
+from nti.segments.templates import Parameter
+from nti.segments.templates import ParameterizedFilterSet
+from nti.segments.templates import SegmentTemplate
+
+from nti.segments.tests import SharedConfiguringTestLayer
+
+from nti.segments.tests.test_model import TestFilterSet
+
+
+class CountingFilterSet(TestFilterSet):
+
+    applied = 0
+
+    def apply(self, initial_set):
+        self.applied += 1
+        return initial_set.intersection(TestFilterSet.apply(self, initial_set))
+
+
+class TestSegmentTemplate(TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def setUp(self):
+        self.shared = CountingFilterSet(range(10))
+        self.template = SegmentTemplate(IntersectionUserFilterSet(filter_sets=(
+            UnionUserFilterSet(filter_sets=(self.shared,)),
+            UnionUserFilterSet(filter_sets=(
+                ParameterizedFilterSet(TestFilterSet, ids=Parameter('ids')),)),
+        )))
+
+    def test_bind(self):
+        assert_that(self.template.parameters, contains('ids'))
+        bound = self.template.bind(ids=(1, 2))
+        assert_that(self.template.bind(ids=(1, 2)), is_(same_instance(bound)))
+        assert_that(self.template.bind(ids=(3,)), is_not(same_instance(bound)))
+        # Unparameterized subtrees are shared
+        assert_that(bound.filter_sets[0],
+                    is_(same_instance(self.template.bind(ids=(3,)).filter_sets[0])))
+        assert_that(bound.filter_sets[1].filter_sets[0].ids, contains(1, 2))
+
+        assert_that(calling(self.template.bind), raises(KeyError))
+
+    def test_evaluate(self):
+        initial = IntIdSet(BTrees.family64.IF.Set(range(5, 20)))
+        results = self.template.evaluate([{'ids': (1, 6)}, {'ids': (7, 8, 15)}],
+                                         initial)
+        assert_that([list(x.intids()) for x in results],
+                    contains(contains(6), contains(7, 8)))
+        # The shared prefix was evaluated once
+        assert_that(self.shared.applied, is_(1))
+
+    def test_cache(self):
+        initial = IntIdSet(BTrees.family64.IF.Set(range(5, 20)))
+        results = self.template.evaluate([{'ids': (1, 6)}, {'ids': [1, 6]}, {'ids': (7,)}],
+                                         initial)
+        # Repeated bindings share a result within the call
+        assert_that(results[1], is_(same_instance(results[0])))
+        assert_that(list(results[2].intids()), contains(7))
+        assert_that(self.shared.applied, is_(1))
+
+        # But not between calls, as the indexes may have changed
+        again = self.template.evaluate([{'ids': (1, 6)}], initial)
+        assert_that(again[0], is_not(same_instance(results[0])))
+        assert_that(self.shared.applied, is_(2))
+
+    def test_least_recently_used(self):
+        template = SegmentTemplate(self.template.filter_set, max_bindings=2)
+        first = template.bind(ids=[1])
+        second = template.bind(ids=[2])
+        assert_that(template.bind(ids=[1]), is_(same_instance(first)))
+        template.bind(ids=[3])
+        assert_that(template.bind(ids=[1]), is_(same_instance(first)))
+        assert_that(template.bind(ids=[2]), is_not(same_instance(second)))
+
+    def test_union(self):
+        # Without an intersection at the root there is no shared prefix
+        template = SegmentTemplate(UnionUserFilterSet(filter_sets=(
+            self.shared,
+            ParameterizedFilterSet(TestFilterSet, ids=Parameter('ids')))))
+        initial = IntIdSet(BTrees.family64.IF.Set(range(5, 20)))
+        results = template.evaluate([{'ids': (15,)}, {'ids': (16, 17)}], initial)
+        assert_that([list(x.intids()) for x in results],
+                    contains(contains(5, 6, 7, 8, 9, 15),
+                             contains(5, 6, 7, 8, 9, 16, 17)))
+        assert_that(self.shared.applied, is_(1))
+
+    def test_not_and_difference(self):
+        excluded = ParameterizedFilterSet(TestFilterSet, ids=Parameter('excluded'))
+        template = SegmentTemplate(IntersectionUserFilterSet(filter_sets=(
+            UnionUserFilterSet(filter_sets=(self.shared,)),
+            NotUserFilterSet(filter_set=excluded),
+            DifferenceUserFilterSet(
+                filter_set=ParameterizedFilterSet(TestFilterSet, ids=Parameter('ids')),
+                excluded_filter_set=TestFilterSet([2])),
+        )))
+        bound = template.bind(ids=(1, 2, 3, 11), excluded=(3,))
+        assert_that(bound.filter_sets[1].filter_set.ids, contains(3))
+        assert_that(bound.filter_sets[2].filter_set.ids, contains(1, 2, 3, 11))
+        assert_that(bound.filter_sets[2].excluded_filter_set,
+                    is_(same_instance(template.filter_set.filter_sets[2].excluded_filter_set)))
+
+        initial = IntIdSet(BTrees.family64.IF.Set(range(20)))
+        result, = template.evaluate([{'ids': (1, 2, 3, 11), 'excluded': (3,)}], initial)
+        assert_that(list(result.intids()), contains(1))
+
+    def test_unbound(self):
+        leaf = ParameterizedFilterSet(TestFilterSet, ids=Parameter('ids'))
+        assert_that(calling(leaf.apply).with_args(None), raises(ValueError))